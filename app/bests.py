@@ -1,37 +1,331 @@
-from tinydb import Query
-from monkeytype import Monkeytype
+from collections import namedtuple
+from storage import Generation
+from offload import Offload
+
+
+class Best(
+    namedtuple(
+        "Best",
+        (
+            "user",
+            "category",
+            "duration",
+            "difficulty",
+            "language",
+            "punctuation",
+            "lazyMode",
+            "wpm",
+            "acc",
+            "timestamp",
+        ),
+    )
+):
+    "a compact personal best holding only the fields the leaderboard needs"
+
+    __slots__ = ()
+
+    @property
+    def key(self):
+        "identifies a personal best across refreshes"
+        return self[:7]
+
+    @property
+    def group(self):
+        "the leaderboard group the personal best belongs to"
+        return self[1:6]
+
+    @classmethod
+    def from_record(cls, record):
+        "builds a personal best from a table record"
+        return cls(*(record.get(field) for field in cls._fields))
 
 
 class Bests:
     "keeps track of registered users personal bests"
 
-    def __init__(self, db):
+    # the fields of a query fragment that a leaderboard is grouped by
+    index_fields = ("category", "duration", "difficulty", "language", "punctuation")
+
+    # the fields that identify a single personal best of a user
+    key_fields = Best._fields[:7]
+
+    # the most rows written to the table at once
+    batch_size = 500
+
+    def __init__(
+        self, db, monkeytype, snapshot=None, offload=None, history=None, change_log=0
+    ):
+        self.db = db
         self.table = db.table("bests")
+        self.monkeytype = monkeytype
+        # an optional faster way to load the index than reading the table,
+        # and the generation it was last saved at
+        self.snapshot = snapshot
+        self.snapshotted = None
+        # where profiles are normalized, inline on the event loop by default
+        self.offload = offload if offload is not None else Offload()
+        # an optional log of every personal best that changed
+        self.history = history
+        # bumped whenever the bests table is written. replicas following the
+        # table need the users each write changed logged, so they can reload
+        # only those
+        self.generation = Generation(db, "bests", log=change_log)
+        self.index = None
+        # user -> key -> personal best, so a user's bests can be diffed
+        # without walking every group
+        self.by_user = None
+        # bumped whenever personal bests change, each group remembers the
+        # version it was last changed at so renders can be cached per group
+        self.version = 0
+        self.versions = {}
+        # the digest of each user's profile when their bests were last saved
+        self.saved = {}
+        # callbacks notified with the personal bests that changed
+        self.subscribers = []
 
     async def fetch_and_save(self, username):
         "fetches user's personal bests and writes to table"
-        m = Monkeytype()
-        profile = await m.get_profile(username=username)
-        data = self.normalize_profile_data(profile)
-        self.table.insert_multiple(data)
-
-    def normalize_profile_data(self, profile):
-        "flattens and enriches personal bests data"
-        flattened = []
-        bests = profile["data"]["personalBests"]
-        for category in bests:
-            for duration in bests[category]:
-                for best in bests[category][duration]:
-                    best["category"] = category
-                    best["duration"] = duration
-                    best["user"] = profile["data"]["name"]
-                    flattened.append(best)
-        return flattened
-
-    def get(self, fragment):
-        return self.table.search(Query().fragment(fragment))
-
-    def overwrite(self, data):
-        "overwrites all personal bests data"
-        self.table.truncate()
-        self.table.insert_multiple(data)
+        profile = await self.monkeytype.get_profile(username)
+        await self.save(username, profile)
+
+    async def save(self, username, profile):
+        """
+        writes the personal bests of a fetched profile, skipping profiles
+        whose personal bests haven't changed since they were last saved
+        """
+        digest = self.monkeytype.get_digest(username)
+        if digest is not None and self.saved.get(username) == digest:
+            return {"inserted": 0, "updated": 0, "deleted": 0}
+        data = await self.offload.run(self.normalize, profile)
+        changes = self.sync(data, users=[profile["data"]["name"]])
+        self.saved[username] = digest
+        return changes
+
+    async def normalize_many(self, profiles):
+        "flattens the personal bests of several profiles into compact rows"
+        data = []
+        for profile in profiles:
+            data += await self.offload.run(self.normalize, profile)
+        return data
+
+    def subscribe(self, callback):
+        "registers a callback to be notified with changed personal bests"
+        self.subscribers.append(callback)
+
+    @staticmethod
+    def normalize(profile):
+        "normalizes a whole profile at once, so it can be done off the event loop"
+        return list(Bests.normalize_profile_data(profile))
+
+    @staticmethod
+    def normalize_profile_data(profile):
+        "flattens personal bests data into compact rows, one at a time"
+        name = profile["data"]["name"]
+        for category, durations in profile["data"]["personalBests"].items():
+            for duration, bests in durations.items():
+                for best in bests:
+                    yield Best(
+                        name,
+                        category,
+                        duration,
+                        best.get("difficulty"),
+                        best.get("language"),
+                        best.get("punctuation"),
+                        best.get("lazyMode"),
+                        best["wpm"],
+                        best["acc"],
+                        best.get("timestamp"),
+                    )
+
+    def get(self, fragment, users=None):
+        """
+        returns the personal bests matching a fragment, ranked by wpm then
+        accuracy. when users is given, only the bests of those users are returned
+        """
+        if self.index is None:
+            self.build_index()
+        results = self.index.get(self.index_key(fragment), [])
+        if users is not None:
+            results = [best for best in results if best.user in users]
+        return results
+
+    def get_version(self, fragment):
+        "the version of the personal bests matching a fragment"
+        if self.index is None:
+            self.build_index()
+        return self.versions.get(self.index_key(fragment), 0)
+
+    def sync(self, data, users=None):
+        """
+        writes only the personal bests that changed compared to the table.
+        when users is given, only the bests of those users are compared so
+        bests of everyone else are left untouched.
+        returns how many rows were inserted, updated and deleted
+        """
+        # the check and the writes share a transaction, which holds the store's
+        # write lock, so another replica can't write the table in between
+        with self.db.transaction():
+            # another replica may have written the table since it was indexed
+            if self.index is None:
+                self.build_index()
+            else:
+                self.reload_if_changed()
+            if users is not None and not data:
+                # forgotten users have to be written again if they come back,
+                # even when their profile hasn't changed since
+                for user in users:
+                    self.saved.pop(user, None)
+            scope = self.by_user if users is None else users
+            current = {
+                key: best
+                for user in scope
+                for key, best in self.by_user.get(user, {}).items()
+            }
+            latest = {best.key: best for best in data}
+
+            inserted = [best for key, best in latest.items() if key not in current]
+            updated = [
+                best
+                for key, best in latest.items()
+                if key in current and current[key] != best
+            ]
+            deleted = [best for key, best in current.items() if key not in latest]
+            if not (inserted or updated or deleted):
+                return {"inserted": 0, "updated": 0, "deleted": 0}
+
+            for start in range(0, len(inserted), self.batch_size):
+                batch = inserted[start : start + self.batch_size]
+                self.table.insert_multiple([best._asdict() for best in batch])
+            for best in updated:
+                self.table.update(best._asdict(), **self.match(best))
+            for best in deleted:
+                self.table.remove(**self.match(best))
+            fresh = self.generation.bump(
+                {best.user for best in inserted + updated + deleted}
+            )
+        if self.history is not None:
+            self.history.record_changes(
+                [(current.get(best.key), best) for best in inserted + updated]
+            )
+
+        if fresh:
+            self.remove_from_index(updated + deleted)
+            self.add_to_index(inserted + updated)
+        else:
+            # another process wrote the table unnoticed, only a reload picks it up
+            self.reload_if_changed()
+        for subscriber in self.subscribers:
+            subscriber(inserted + updated + deleted)
+        return {
+            "inserted": len(inserted),
+            "updated": len(updated),
+            "deleted": len(deleted),
+        }
+
+    def build_index(self):
+        "groups and ranks every personal best in the table"
+        # groups that no longer have bests still need their version bumped
+        emptied = set(self.index or ())
+        self.index = {}
+        self.by_user = {}
+        generation = self.generation.refresh()
+        groups = None
+        if self.snapshot is not None:
+            groups = self.snapshot.load(generation)
+        if groups is None:
+            self.add_to_index(Best.from_record(record) for record in self.table.all())
+        else:
+            # the snapshot's groups are already ranked
+            self.index = groups
+            for group in groups.values():
+                for best in group:
+                    self.by_user.setdefault(best.user, {})[best.key] = best
+            self.bump(groups)
+        self.bump(emptied - set(self.index))
+
+    def get_generation(self):
+        "the generation of the bests table, bumped every time it's written"
+        return self.generation.get()
+
+    def reload_if_changed(self):
+        "rebuilds the index when another replica wrote the table"
+        if self.index is None or not self.generation.is_stale():
+            return False
+        users = self.generation.changed()
+        if users is None:
+            self.build_index()
+        else:
+            self.reload_users(users)
+        return True
+
+    def reload_users(self, users):
+        "reads the personal bests of some users back from the table into the index"
+        stale = [best for user in users for best in self.by_user.get(user, {}).values()]
+        self.remove_from_index(stale)
+        self.add_to_index(
+            Best.from_record(record)
+            for user in users
+            for record in self.table.search(user=user)
+        )
+
+    def save_snapshot(self):
+        """
+        snapshots the index so the next start doesn't have to read the table,
+        unless it wasn't written since the last snapshot
+        """
+        if self.snapshot is None or self.index is None:
+            return
+        generation = self.generation.get()
+        if generation == self.snapshotted:
+            return
+        bests = (best for group in self.index.values() for best in group)
+        self.snapshot.save(bests, generation)
+        self.snapshotted = generation
+
+    def add_to_index(self, data):
+        "inserts personal bests into their group, keeping each group ranked"
+        touched = set()
+        for best in data:
+            self.index.setdefault(best.group, []).append(best)
+            self.by_user.setdefault(best.user, {})[best.key] = best
+            touched.add(best.group)
+        # groups are already mostly sorted, so re-sorting them is cheap
+        for key in touched:
+            self.index[key].sort(key=self.rank)
+        self.bump(touched)
+
+    def remove_from_index(self, data):
+        "drops the indexed personal bests sharing a key with the given ones"
+        stale = {}
+        for best in data:
+            stale.setdefault(best.group, set()).add(best.key)
+            user = self.by_user.get(best.user, {})
+            user.pop(best.key, None)
+            if not user:
+                self.by_user.pop(best.user, None)
+        for key, rows in stale.items():
+            self.index[key] = [
+                best for best in self.index.get(key, []) if best.key not in rows
+            ]
+        self.bump(stale)
+
+    def bump(self, keys):
+        "marks groups of personal bests as changed"
+        if not keys:
+            return
+        self.version += 1
+        for key in keys:
+            self.versions[key] = self.version
+
+    def index_key(self, fragment):
+        "the leaderboard group a fragment selects"
+        return tuple(fragment.get(field) for field in self.index_fields)
+
+    def match(self, best):
+        "the table match selecting a personal best"
+        return dict(zip(self.key_fields, best.key))
+
+    @staticmethod
+    def rank(best):
+        "sort key ordering by WPM with accuracy as the tiebreaker"
+        return (-best.wpm, -best.acc)
@@ -0,0 +1,176 @@
+import json
+import mmap
+import os
+import struct
+from array import array
+from bests import Best
+
+
+class BestsColumns:
+    """
+    personal bests stored column by column
+
+    numeric fields live in typed arrays and text fields are dictionary encoded
+    into integer codes, so the columns can be written to a file and read back
+    without encoding or parsing every row
+    """
+
+    # fields stored as codes into a dictionary of their distinct values
+    encoded = ("user", "category", "duration", "difficulty", "language")
+    # booleans stored as 0 or 1, with -1 when a field is missing
+    flags = ("punctuation", "lazyMode")
+    # the array type code of every column
+    typecodes = {
+        **{field: "i" for field in encoded},
+        **{field: "b" for field in flags},
+        "wpm": "d",
+        "acc": "d",
+        "timestamp": "q",
+    }
+
+    # files start with the length of a JSON header describing the columns
+    header = struct.Struct("<Q")
+
+    def __init__(self, generation=0):
+        self.generation = generation
+        self.columns = {field: array(code) for field, code in self.typecodes.items()}
+        self.values = {field: [] for field in self.encoded}
+        self.codes = {field: {} for field in self.encoded}
+
+    def __len__(self):
+        return len(self.columns["wpm"])
+
+    @classmethod
+    def from_bests(cls, bests, generation=0):
+        "encodes personal bests into columns"
+        columns = cls(generation)
+        for best in bests:
+            columns.append(best)
+        return columns
+
+    def append(self, best):
+        "adds a personal best to the end of the columns"
+        for field in self.encoded:
+            self.columns[field].append(self.encode(field, getattr(best, field)))
+        for field in self.flags:
+            value = getattr(best, field)
+            self.columns[field].append(-1 if value is None else int(value))
+        self.columns["wpm"].append(best.wpm)
+        self.columns["acc"].append(best.acc)
+        self.columns["timestamp"].append(best.timestamp or 0)
+
+    def encode(self, field, value):
+        "the code of a value, adding it to the field's dictionary if it's new"
+        codes = self.codes[field]
+        if value not in codes:
+            codes[value] = len(self.values[field])
+            self.values[field].append(value)
+        return codes[value]
+
+    def bests(self, indices=None):
+        "decodes personal bests, every one of them unless indices are given"
+        if indices is None:
+            indices = range(len(self))
+        if not indices:
+            return []
+        # decode column by column rather than row by row
+        fields = []
+        for field in Best._fields:
+            column = self.columns[field]
+            values = [column[idx] for idx in indices]
+            if field in self.encoded:
+                values = map(self.values[field].__getitem__, values)
+            elif field in self.flags:
+                values = map(self.flag, values)
+            elif field == "timestamp":
+                values = (timestamp or None for timestamp in values)
+            fields.append(values)
+        return list(map(Best._make, zip(*fields)))
+
+    @staticmethod
+    def flag(value):
+        "decodes a stored boolean"
+        return None if value == -1 else bool(value)
+
+    def rank(self, indices):
+        "orders indices by WPM with accuracy as the tiebreaker, best first"
+        # sorting is stable, so sorting by the tiebreaker first and the main key
+        # second orders by both without building a key tuple per row
+        ranked = sorted(indices, key=self.columns["acc"].__getitem__, reverse=True)
+        ranked.sort(key=self.columns["wpm"].__getitem__, reverse=True)
+        return ranked
+
+    def groups(self):
+        "every leaderboard group and its personal bests, already ranked"
+        keys = list(zip(*(self.columns[field] for field in Best._fields[1:6])))
+        groups = {}
+        for idx in self.rank(range(len(self))):
+            groups.setdefault(keys[idx], []).append(idx)
+        return {
+            bests[0].group: bests
+            for bests in (self.bests(ranked) for ranked in groups.values())
+        }
+
+    def save(self, path):
+        "writes the columns to a file, replacing it atomically"
+        header = json.dumps(
+            {
+                "generation": self.generation,
+                "length": len(self),
+                "values": self.values,
+                "columns": list(self.typecodes),
+            }
+        ).encode()
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.header.pack(len(header)))
+            f.write(header)
+            for field in self.typecodes:
+                self.columns[field].tofile(f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        "maps a file written by save back into columns"
+        with open(path, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as mm:
+            (size,) = cls.header.unpack_from(mm)
+            offset = cls.header.size
+            meta = json.loads(mm[offset : offset + size])
+            offset += size
+            columns = cls(meta["generation"])
+            for field in meta["columns"]:
+                column = columns.columns[field]
+                end = offset + meta["length"] * column.itemsize
+                column.frombytes(mm[offset:end])
+                offset = end
+        for field in cls.encoded:
+            columns.values[field] = meta["values"][field]
+            columns.codes[field] = {
+                value: code for code, value in enumerate(meta["values"][field])
+            }
+        return columns
+
+
+class ColumnarSnapshot:
+    "persists the personal bests index as a columnar file for fast restarts"
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, generation):
+        """
+        the ranked leaderboard groups of the snapshot, or None when there's no
+        snapshot or it was taken at a different generation than the table's
+        """
+        if not os.path.exists(self.path):
+            return None
+        columns = BestsColumns.load(self.path)
+        if columns.generation != generation:
+            return None
+        return columns.groups()
+
+    def save(self, bests, generation):
+        "snapshots the personal bests as of a generation of the table"
+        BestsColumns.from_bests(bests, generation).save(self.path)
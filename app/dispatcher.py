@@ -0,0 +1,77 @@
+import asyncio
+from slack_sdk.errors import SlackApiError
+
+
+class ViewDispatcher:
+    """
+    pushes personal best changes to the open leaderboard views they affect
+
+    changes arriving within the debounce window are coalesced into a single
+    update per view, and updates are sent one at a time through a queue that
+    backs off when slack says we're being rate limited
+    """
+
+    def __init__(self, leaderboard, bests, users, logger, debounce=5, interval=1):
+        self.leaderboard = leaderboard
+        self.bests = bests
+        self.users = users
+        self.logger = logger
+        self.debounce = debounce
+        self.interval = interval
+        self.pending = set()
+        self.queued = set()
+        self.queue = asyncio.Queue()
+        self.flush_handle = None
+
+    def notify(self, changed):
+        "schedules an update of every open view showing a changed personal best"
+        groups = {}
+        for best in changed:
+            groups.setdefault(best.group, set()).add(best.user)
+        for view in self.leaderboard.get_views():
+            changed_users = groups.get(self.bests.index_key(view["fragment"]))
+            members = self.users.get_members(view["channel"])
+            if changed_users and not members.isdisjoint(changed_users):
+                self.pending.add(view["view"])
+        if self.pending and self.flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self.flush_handle = loop.call_later(self.debounce, self.flush)
+
+    def flush(self):
+        "moves the views that changed during the debounce window onto the queue"
+        self.flush_handle = None
+        for view_id in self.pending - self.queued:
+            self.queued.add(view_id)
+            self.queue.put_nowait(view_id)
+        self.pending.clear()
+
+    async def run(self):
+        "sends queued view updates, pacing them to respect slack's rate limits"
+        while True:
+            view_id = await self.queue.get()
+            self.queued.discard(view_id)
+            if not self.leaderboard.is_open(view_id):
+                continue
+            try:
+                await self.leaderboard.refresh(view_id)
+            except SlackApiError as e:
+                if e.response["error"] == "ratelimited":
+                    delay = int(e.response.headers.get("Retry-After", 1))
+                    self.logger.warning(
+                        "rate limited updating view %s, retrying in %s seconds",
+                        view_id,
+                        delay,
+                    )
+                    await asyncio.sleep(delay)
+                    self.queued.add(view_id)
+                    self.queue.put_nowait(view_id)
+                    continue
+                self.logger.warning("could not update view %s: %s", view_id, e)
+            except LookupError as e:
+                # the app was uninstalled from the view's workspace
+                self.logger.warning("could not update view %s: %s", view_id, e)
+            except Exception:  # pylint: disable=broad-except
+                # a connection error or timeout only loses this update, the
+                # loop keeps serving every other open view
+                self.logger.exception("could not update view %s", view_id)
+            await asyncio.sleep(self.interval)
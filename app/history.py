@@ -0,0 +1,274 @@
+import json
+import math
+import os
+import struct
+import time
+from bests import Best
+
+
+class History:
+    """
+    an append-only log of personal best changes, kept in segment files that
+    are rotated once they reach a size
+
+    every record holds the value it replaced, so progress over a period only
+    needs the records written during it. an index of the range of offsets
+    each user's records span in every segment lets queries skip the segments
+    and stretches that hold none of them. segments older than the retention
+    are deleted, and their entries dropped from the index
+    """
+
+    # recorded at, wpm, acc, previous wpm and acc (nan for a new personal best)
+    # and the length of the personal best's key that follows
+    record = struct.Struct("<dddddH")
+
+    def __init__(self, path, logger, segment_size=1 << 20, retention=None):
+        self.path = path
+        self.logger = logger
+        self.segment_size = segment_size
+        # seconds records are kept for, forever when None
+        self.retention = retention
+        # only the process refreshing personal bests appends to the log
+        self.writable = False
+        # user -> segment -> [offset of the first record, end of the last]
+        self.users = {}
+        # segment -> [first recorded at, last recorded at]
+        self.segments = {}
+        # the segment and offset up to which records are indexed
+        self.position = (0, 0)
+        self.file = None
+        # when the most improved digest was last posted
+        self.digest_sent = 0
+
+    def segment_path(self, segment):
+        return os.path.join(self.path, f"{segment:08d}.seg")
+
+    def index_path(self):
+        return os.path.join(self.path, "index.json")
+
+    def load(self):
+        "reads the saved index and indexes any records appended after it"
+        os.makedirs(self.path, exist_ok=True)
+        index = None
+        if os.path.exists(self.index_path()):
+            with open(self.index_path()) as f:
+                index = json.load(f)
+        if index is not None and "segments" in index:
+            self.position = tuple(index["position"])
+            self.digest_sent = index["digest_sent"]
+            # JSON keys are strings, segments are numbers
+            self.users = {
+                user: {int(segment): span for segment, span in segments.items()}
+                for user, segments in index["users"].items()
+            }
+            self.segments = {
+                int(segment): times for segment, times in index["segments"].items()
+            }
+        else:
+            # no index, or one from before offset ranges, so everything still
+            # on disk is indexed again
+            if index is not None:
+                self.digest_sent = index["digest_sent"]
+            self.position = (self.first_segment(), 0)
+        self.catch_up()
+
+    def first_segment(self):
+        "the oldest segment on disk, where indexing starts from scratch"
+        segments = [
+            int(name[: -len(".seg")])
+            for name in os.listdir(self.path)
+            if name.endswith(".seg")
+        ]
+        return min(segments, default=0)
+
+    def index_record(self, username, recorded, segment, start, end):
+        "adds a record to the offset range of its user and its segment's times"
+        span = self.users.setdefault(username, {}).setdefault(segment, [start, end])
+        span[1] = end
+        times = self.segments.setdefault(segment, [recorded, recorded])
+        times[1] = recorded
+
+    def catch_up(self):
+        "indexes the records appended since the log was last indexed"
+        segment, offset = self.position
+        while os.path.exists(self.segment_path(segment)):
+            with open(self.segment_path(segment), "rb") as f:
+                f.seek(offset)
+                for start, recorded, key, *_ in self.read_records(f):
+                    # records are only yielded once they were read in full
+                    offset = f.tell()
+                    self.index_record(key[0], recorded, segment, start, offset)
+            self.position = (segment, offset)
+            if not os.path.exists(self.segment_path(segment + 1)):
+                break
+            segment, offset = segment + 1, 0
+
+    def save_index(self):
+        "writes the index, replacing the previous one atomically"
+        tmp = f"{self.index_path()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(
+                {
+                    "position": self.position,
+                    "digest_sent": self.digest_sent,
+                    "users": self.users,
+                    "segments": self.segments,
+                },
+                f,
+            )
+        os.replace(tmp, self.index_path())
+
+    def record_changes(self, changes):
+        "appends personal bests that changed, given as (previous, latest) pairs"
+        if not self.writable or not changes:
+            return
+        recorded = time.time()
+        segment, offset = self.position
+        if self.file is None:
+            self.file = open(self.segment_path(segment), "ab")
+            # drop whatever a crash left half written
+            self.file.truncate(offset)
+        chunk = bytearray()
+        for previous, best in changes:
+            key = json.dumps(best.key, separators=(",", ":")).encode()
+            chunk += self.record.pack(
+                recorded,
+                best.wpm,
+                best.acc,
+                math.nan if previous is None else previous.wpm,
+                math.nan if previous is None else previous.acc,
+                len(key),
+            )
+            chunk += key
+            end = offset + self.record.size + len(key)
+            self.index_record(best.user, recorded, segment, offset, end)
+            offset = end
+        self.file.write(chunk)
+        self.file.flush()
+        self.position = (segment, offset)
+        if offset >= self.segment_size:
+            self.rotate()
+
+    def mark_digest_sent(self):
+        "records that the most improved digest was just posted"
+        self.digest_sent = time.time()
+        self.save_index()
+
+    def rotate(self):
+        "starts a new segment, deleting the segments past the retention"
+        self.file.close()
+        self.file = None
+        self.position = (self.position[0] + 1, 0)
+        if self.retention is not None:
+            self.prune(time.time() - self.retention)
+        self.save_index()
+        self.logger.info("history rotated to segment %s", self.position[0])
+
+    def prune(self, before):
+        "deletes the segments holding only records older than a time, returning them"
+        pruned = [
+            segment
+            for segment, (_, last) in self.segments.items()
+            if last < before and segment != self.position[0]
+        ]
+        for segment in pruned:
+            del self.segments[segment]
+            try:
+                os.remove(self.segment_path(segment))
+            except FileNotFoundError:
+                pass
+        for username in list(self.users):
+            segments = self.users[username]
+            for segment in pruned:
+                segments.pop(segment, None)
+            if not segments:
+                del self.users[username]
+        if pruned:
+            self.logger.info("history pruned %s segments", len(pruned))
+        return pruned
+
+    def close(self):
+        "closes the current segment and saves the index"
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.writable:
+            self.save_index()
+
+    def read_records(self, f):
+        "yields the offset, time, key, wpm, acc, previous wpm and previous acc of records"
+        while True:
+            offset = f.tell()
+            header = f.read(self.record.size)
+            if len(header) < self.record.size:
+                return
+            recorded, wpm, acc, previous_wpm, previous_acc, size = self.record.unpack(
+                header
+            )
+            key = f.read(size)
+            if len(key) < size:
+                # a record still being written
+                return
+            key = tuple(json.loads(key))
+            yield offset, recorded, key, wpm, acc, previous_wpm, previous_acc
+
+    def get_records(self, username, since):
+        "the records of a user written since a time, oldest first"
+        records = []
+        for segment, (start, end) in sorted(self.users.get(username, {}).items()):
+            if self.segments[segment][1] < since:
+                continue
+            try:
+                f = open(self.segment_path(segment), "rb")
+            except FileNotFoundError:
+                # pruned by the process writing the log since it was indexed
+                continue
+            with f:
+                f.seek(start)
+                for record in self.read_records(f):
+                    if record[0] >= end:
+                        break
+                    # other users' records share the range
+                    if record[2][0] == username and record[1] >= since:
+                        records.append(record)
+        return records
+
+    def get_progress(self, username, days):
+        """
+        how a user's personal bests improved over the last days, as
+        (group, wpm before, wpm now) for each group that had a personal best
+        before the period and improved during it, most improved first
+        """
+        first, last = {}, {}
+        for _, _, key, wpm, _, previous_wpm, _ in self.get_records(
+            username, time.time() - days * 86400
+        ):
+            first.setdefault(key, previous_wpm)
+            last[key] = wpm
+        progress = [
+            (Best(*key, None, None, None).group, first[key], last[key])
+            for key in last
+            if not math.isnan(first[key]) and last[key] > first[key]
+        ]
+        return sorted(progress, key=lambda p: p[1] - p[2])
+
+    def get_most_improved(self, usernames, days=7, limit=3):
+        """
+        the users whose personal bests improved the most over the last days,
+        as (username, group, wpm before, wpm now), most improved first
+        """
+        improved = []
+        for username in usernames:
+            progress = self.get_progress(username, days)
+            if progress:
+                improved.append((username, *progress[0]))
+        improved.sort(key=lambda i: i[2] - i[3])
+        return improved[:limit]
+
+
+def format_group(group):
+    "describes a leaderboard group, like 60s normal english with punctuation"
+    category, duration, difficulty, language, punctuation = group
+    length = f"{duration}s" if category == "time" else f"{duration} words"
+    description = f"{length} {difficulty} {language}"
+    return description + (" with punctuation" if punctuation else "")
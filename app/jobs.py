@@ -0,0 +1,49 @@
+import asyncio
+from metrics import metrics
+
+
+class Jobs:
+    """
+    runs the slow work triggered by handlers in the background so handlers
+    can ack slack right away
+
+    every kind of job has its own concurrency limit, and failures are logged
+    and handed to the job's error callback so they can be reported to the user
+    """
+
+    def __init__(self, logger, concurrency=4):
+        self.logger = logger
+        self.concurrency = concurrency
+        self.semaphores = {}
+        self.tasks = set()
+        # how many jobs of each kind are running, exposed as a gauge
+        self.running = {}
+
+    def submit(self, kind, job, on_error=None):
+        "schedules a job coroutine, calling on_error with the exception if it fails"
+        task = asyncio.create_task(self.run(kind, job, on_error))
+        # keep a reference so the task isn't garbage collected mid-flight
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def run(self, kind, job, on_error):
+        "runs a job once a slot for its kind is free"
+        semaphore = self.semaphores.setdefault(
+            kind, asyncio.Semaphore(self.concurrency)
+        )
+        if kind not in self.running:
+            self.running[kind] = 0
+            metrics.gauge("jobs_running", lambda: self.running[kind], kind=kind)
+        async with semaphore:
+            self.running[kind] += 1
+            try:
+                await job
+                metrics.increment("jobs_total", kind=kind, outcome="done")
+            except Exception as e:  # pylint: disable=broad-except
+                metrics.increment("jobs_total", kind=kind, outcome="failed")
+                self.logger.exception("%s job failed", kind)
+                if on_error is not None:
+                    await on_error(e)
+            finally:
+                self.running[kind] -= 1
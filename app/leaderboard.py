@@ -1,9 +1,16 @@
-from tinydb import where
-from tinydb.operations import set
+import hashlib
+import json
+import math
+import time
+from metrics import metrics
 from monkeytype import Monkeytype
 
 
 class Leaderboard:
+    # how many results are shown per page, slack rejects modals with more
+    # than 100 blocks
+    page_size = 25
+
     default_query = {
         "category": "time",
         "duration": "60",
@@ -12,16 +19,70 @@ class Leaderboard:
         "punctuation": False,
     }
 
-    def __init__(self, db, bests, client, logger):
+    # register and settings buttons shown above every leaderboard
+    header_blocks = [
+        {
+            "type": "divider",
+        },
+        {
+            "type": "actions",
+            "elements": [
+                {
+                    "type": "button",
+                    "text": {
+                        "type": "plain_text",
+                        "text": ":monkey_face: register a new typer!",
+                        "emoji": True,
+                    },
+                    "action_id": "register",
+                },
+                {
+                    "type": "button",
+                    "text": {
+                        "type": "plain_text",
+                        "text": ":gear: Settings",
+                        "emoji": True,
+                    },
+                    "action_id": "settings",
+                },
+            ],
+        },
+        {"type": "divider"},
+        {
+            "type": "header",
+            "text": {
+                "type": "plain_text",
+                "text": ":trophy: Leaderboard",
+                "emoji": True,
+            },
+        },
+    ]
+
+    def __init__(self, db, bests, users, workspaces, logger, cache=True):
         self.table = db.table("leaderboards")
         self.bests = bests
-        self.client = client
+        self.users = users
+        self.workspaces = workspaces
         self.logger = logger
+        # the state of each open view, written through to the table. replicas
+        # sharing the table can't cache it, since any of them may write a view
+        self.cache = cache
+        self.views = {}
+        # a hash of the blocks last shown by each view. only kept along with
+        # the cache, since other replicas may push to a view too
+        self.pushed = {}
+        # the latest render of each group of personal bests, keyed by group
+        # and tagged with the version of the personal bests it rendered
+        self.rendered = {}
+        # the ranked personal bests of each channel's members, keyed by group
+        # and channel and tagged with the versions they were ranked at
+        self.ranked = {}
 
     async def open(self, channel, trigger_id):
         "opens the root leaderboard view"
-        blocks = self.build_view_blocks(self.default_query)
-        response = await self.client.views_open(
+        blocks, digest = self.render(self.default_query, channel)
+        client, _ = await self.workspaces.get_channel_client(channel)
+        response = await client.views_open(
             trigger_id=trigger_id,
             view={
                 "type": "modal",
@@ -34,22 +95,119 @@ class Leaderboard:
                 "blocks": blocks,
             },
         )
-        view = response["view"]["id"]
-        self.table.insert(
-            {"view": view, "channel": channel, "fragment": self.default_query}
+        view = {
+            "view": response["view"]["id"],
+            "team": self.workspaces.split(channel)[0],
+            "channel": channel,
+            "fragment": self.default_query,
+            "settings": None,
+            "page": 0,
+            "touched": time.time(),
+        }
+        if self.cache:
+            self.pushed[view["view"]] = digest
+        self.table.insert(view)
+        if self.cache:
+            self.views[view["view"]] = view
+
+    def get_view(self, view_id):
+        """
+        the state of a view: its channel, query fragment, settings selections
+        and page. read from the table only when it isn't cached. None when the
+        view was closed, expired by the sweeper or never stored
+        """
+        view = self.views.get(view_id)
+        if view is None:
+            view = self.table.get(view=view_id)
+            if view is not None and self.cache:
+                self.views[view_id] = view
+        return view
+
+    def save_view(self, view, fields):
+        "writes fields of a view's state through to the table, returning the state"
+        fields = {**fields, "touched": time.time()}
+        view = {**view, **fields}
+        self.table.update(fields, view=view["view"])
+        if self.cache:
+            self.views[view["view"]] = view
+        return view
+
+    async def update(self, view_id, fragment, settings=None):
+        """
+        sets the leaderboard's filter fragment and the settings selections
+        it was built from, and refreshes the view.
+        returns whether the view's state was found
+        """
+        view = self.get_view(view_id)
+        if view is None:
+            return False
+        view = self.save_view(
+            view, {"fragment": fragment, "settings": settings, "page": 0}
         )
+        await self.show(view)
+        return True
 
-    async def update(self, view_id, fragment):
+    async def turn_page(self, view_id, pages):
         """
-        sets the leaderboard's filter fragment and refreshes the view
+        moves the leaderboard forward or back by a number of pages
+        returns whether the view's state was found
         """
-        self.table.update(set("fragment", fragment), where("view") == view_id)
-        await self.refresh(view_id)
+        view = self.get_view(view_id)
+        if view is None:
+            return False
+        # the results may have shrunk since the page was saved, so it's
+        # clamped to the pages there are now
+        last = self.count_pages(view["fragment"], view["channel"]) - 1
+        page = min(max(view.get("page", 0) + pages, 0), last)
+        await self.show(self.save_view(view, {"page": page}))
+        return True
+
+    async def jump_to(self, view_id, usernames):
+        """
+        shows the page where the best of the given users is ranked
+        returns whether the view's state was found and any of them is ranked
+        """
+        view = self.get_view(view_id)
+        if view is None:
+            return False
+        usernames = set(usernames)
+        ranked = self.get_ranked(view["fragment"], view["channel"])
+        rank = next(
+            (rank for rank, best in enumerate(ranked) if best.user in usernames), None
+        )
+        if rank is None:
+            return False
+        await self.show(self.save_view(view, {"page": rank // self.page_size}))
+        return True
 
     async def refresh(self, view_id):
-        "updates the leaderboard based on the current query fragment"
-        fragment = self.table.get(where("view") == view_id)["fragment"]
-        await self.client.views_update(
+        """
+        updates the leaderboard based on the current query fragment
+        returns whether the view's state was found
+        """
+        view = self.get_view(view_id)
+        if view is None:
+            return False
+        await self.show(view)
+        return True
+
+    async def show(self, view):
+        "pushes the page of the leaderboard a view's state describes"
+        await self.push(
+            view["view"],
+            view["channel"],
+            *self.render(view["fragment"], view["channel"], view.get("page", 0)),
+        )
+
+    async def push(self, view_id, channel, blocks, digest):
+        """
+        updates a leaderboard view unless it already shows these blocks
+        returns whether the view was updated
+        """
+        if self.pushed.get(view_id) == digest:
+            return False
+        client, _ = await self.workspaces.get_channel_client(channel)
+        await client.views_update(
             view_id=view_id,
             view={
                 "type": "modal",
@@ -59,50 +217,57 @@ class Leaderboard:
                     "type": "plain_text",
                     "text": "Monkeytype Leaderboard",
                 },
-                "blocks": self.build_view_blocks(fragment),
+                "blocks": blocks,
             },
         )
+        if self.cache:
+            self.pushed[view_id] = digest
+        return True
 
-    def build_view_blocks(self, fragment):
-        "constructs the leaderboard"
-        # define header block
-        blocks = [
-            {
-                "type": "divider",
-            },
-            {
-                "type": "actions",
-                "elements": [
-                    {
-                        "type": "button",
-                        "text": {
-                            "type": "plain_text",
-                            "text": ":monkey_face: register a new typer!",
-                            "emoji": True,
-                        },
-                        "action_id": "register",
-                    },
-                    {
-                        "type": "button",
-                        "text": {
-                            "type": "plain_text",
-                            "text": ":gear: Settings",
-                            "emoji": True,
-                        },
-                        "action_id": "settings",
-                    },
-                ],
-            },
-            {"type": "divider"},
-            {
-                "type": "header",
-                "text": {
-                    "type": "plain_text",
-                    "text": ":trophy: Leaderboard",
-                    "emoji": True,
-                },
-            },
-        ]
+    def render(self, fragment, channel, page=0):
+        """
+        returns the blocks of a channel's leaderboard page and their hash,
+        reusing the last render of the same page while neither the personal
+        bests nor the channel's members have changed
+        """
+        key = (self.bests.index_key(fragment), channel, page)
+        version = (self.bests.get_version(fragment), self.users.get_version(channel))
+        cached = self.rendered.get(key)
+        if cached is None or cached[0] != version:
+            tic = time.perf_counter()
+            blocks = self.build_view_blocks(fragment, channel, page)
+            metrics.observe("leaderboard_render_seconds", time.perf_counter() - tic)
+            metrics.observe(
+                "leaderboard_render_blocks", len(blocks), buckets=(10, 25, 50, 75, 100)
+            )
+            cached = (version, blocks, self.digest(blocks))
+            self.rendered[key] = cached
+        return cached[1], cached[2]
+
+    def get_ranked(self, fragment, channel):
+        """
+        the personal bests of a channel's members matching a fragment, ranked.
+        the global group is only filtered down to the channel again once
+        either the group or the channel's members changed
+        """
+        key = (self.bests.index_key(fragment), channel)
+        version = (self.bests.get_version(fragment), self.users.get_version(channel))
+        cached = self.ranked.get(key)
+        if cached is None or cached[0] != version:
+            members = self.users.get_members(channel)
+            cached = (version, self.bests.get(fragment, users=members))
+            self.ranked[key] = cached
+        return cached[1]
+
+    def digest(self, blocks):
+        "hashes rendered blocks so identical updates can be skipped"
+        encoded = json.dumps(blocks, sort_keys=True).encode()
+        return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+
+    def build_view_blocks(self, fragment, channel, page=0):
+        "constructs a page of the leaderboard of the users registered in a channel"
+        # the header never changes, so it's shared between renders
+        blocks = list(self.header_blocks)
         # add block describing filters
         filter_description = {"type": "context", "elements": []}
         filter_description["elements"].append(
@@ -122,9 +287,15 @@ class Leaderboard:
         # separate header from results
         blocks.append({"type": "divider"})
 
-        # filter the results table based on the query fragment
-        filtered = self.bests.get(fragment)
-        if len(filtered) == 0:
+        # get the page of results matching the query fragment, already ranked
+        # by WPM with accuracy as the tiebreaker
+        ranked = self.get_ranked(fragment, channel)
+        total = len(ranked)
+        pages = max(math.ceil(total / self.page_size), 1)
+        page = min(page, pages - 1)
+        offset = page * self.page_size
+        results = ranked[offset : offset + self.page_size]
+        if len(results) == 0:
             blocks.append(
                 {
                     "type": "context",
@@ -138,27 +309,62 @@ class Leaderboard:
             )
             return blocks
 
-        # sort the results according to WPM with accuracy as the tiebreaker
-        m = Monkeytype()
-        sorted_results = sorted(filtered, key=lambda r: (-r["wpm"], -r["acc"]))
-        for idx, result in enumerate(sorted_results):
-            u = result["user"]
-            w = result["wpm"]
-            a = result["acc"]
+        for idx, result in enumerate(results, start=offset):
+            u = result.user
+            w = result.wpm
+            a = result.acc
             blocks += [
                 {
                     "type": "context",
                     "elements": [
                         {
                             "type": "mrkdwn",
-                            "text": f"{self.get_position(idx)}<{m.get_profile_link(username=u)}|{u}> {w} wpm - {a}% accuracy",
+                            "text": f"{self.get_position(idx)}<{Monkeytype.get_profile_link(u)}|{u}> {w} wpm - {a}% accuracy",
                         }
                     ],
                 }
             ]
 
+        blocks += self.build_pagination_blocks(page, pages, total)
         return blocks
 
+    def count_pages(self, fragment, channel):
+        "how many pages a channel's leaderboard has, at least one"
+        total = len(self.get_ranked(fragment, channel))
+        return max(math.ceil(total / self.page_size), 1)
+
+    def build_pagination_blocks(self, page, pages, total):
+        "constructs the page description and the buttons to move between pages"
+        buttons = []
+        if page > 0:
+            buttons.append(("previous_page", ":arrow_left: Previous"))
+        if page < pages - 1:
+            buttons.append(("next_page", "Next :arrow_right:"))
+        buttons.append(("my_rank", ":mag: Jump to my rank"))
+        return [
+            {"type": "divider"},
+            {
+                "type": "context",
+                "elements": [
+                    {
+                        "type": "mrkdwn",
+                        "text": f"page {page + 1} of {pages} ({total} results)",
+                    }
+                ],
+            },
+            {
+                "type": "actions",
+                "elements": [
+                    {
+                        "type": "button",
+                        "text": {"type": "plain_text", "text": text, "emoji": True},
+                        "action_id": action_id,
+                    }
+                    for (action_id, text) in buttons
+                ],
+            },
+        ]
+
     def get_position(self, idx):
         "return a medal emoji if you deserve a medal, otherwise return index"
         if idx == 0:
@@ -171,9 +377,56 @@ class Leaderboard:
         return f"{idx+1}. "
 
     def get_channel(self, view):
-        "gets the channel where a leaderboard view was opened"
-        return self.table.get(where("view") == view)["channel"]
+        "gets the channel where a leaderboard view was opened, None if it's gone"
+        state = self.get_view(view)
+        return state["channel"] if state is not None else None
+
+    def get_views(self, team=None):
+        "gets every open leaderboard view, or only those of a team"
+        if team is not None:
+            return self.table.search(team=team)
+        return self.table.all()
+
+    def is_open(self, view):
+        "determines if a leaderboard view is still open"
+        return self.get_view(view) is not None
+
+    def adopt_settings(self, table):
+        """
+        moves the selections kept in the settings table, before they were part
+        of each view's state, into the views and empties it
+        """
+        for row in table.all():
+            if self.table.get(view=row["view_id"]) is not None:
+                settings = {
+                    field: row[field]
+                    for field in ("duration", "difficulty", "punctuation")
+                }
+                self.table.update({"settings": settings}, view=row["view_id"])
+        table.truncate()
+
+    def get_open_channels(self):
+        "gets the channels with at least one open leaderboard view"
+        return {view["channel"] for view in self.table.all()}
 
     def remove(self, view):
         "deletes a closed view from the table"
-        self.table.remove(where("view") == view)
+        self.table.remove(view=view)
+        self.views.pop(view, None)
+        self.pushed.pop(view, None)
+
+    def expire(self, before):
+        """
+        deletes the views nobody touched since a time, returning their ids.
+        views saved before touched times were kept are stamped instead
+        """
+        expired = []
+        for view in self.table.all():
+            touched = view.get("touched")
+            if touched is None:
+                self.table.update({"touched": time.time()}, view=view["view"])
+                self.views.pop(view["view"], None)
+            elif touched < before:
+                self.remove(view["view"])
+                expired.append(view["view"])
+        return expired
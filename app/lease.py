@@ -0,0 +1,57 @@
+import asyncio
+import fcntl
+import os
+import socket
+
+
+class RefreshLease:
+    """
+    a lock on a file shared by every replica, held by the one replica that runs
+    the refresh loop
+
+    the operating system releases the lock when its holder exits or crashes,
+    so a waiting replica takes over without any expiry to tune
+    """
+
+    def __init__(self, path, logger, retry=5):
+        self.path = path
+        self.logger = logger
+        self.retry = retry
+        self.file = None
+
+    @property
+    def held(self):
+        "whether this replica holds the lease"
+        return self.file is not None
+
+    def try_acquire(self):
+        "takes the lease if nobody holds it, returning whether it did"
+        if self.held:
+            return True
+        f = open(self.path, "a+")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return False
+        # note who holds the lease, for whoever is debugging
+        f.seek(0)
+        f.truncate()
+        f.write(f"{socket.gethostname()} {os.getpid()}\n")
+        f.flush()
+        self.file = f
+        return True
+
+    async def acquire(self):
+        "waits until this replica holds the lease"
+        while not self.try_acquire():
+            await asyncio.sleep(self.retry)
+        self.logger.info("this replica holds the refresh lease")
+
+    def release(self):
+        "gives up the lease"
+        if not self.held:
+            return
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
@@ -1,71 +1,271 @@
+import time
+
+# measured from before the heavy imports, to report how long startup took
+STARTED = time.perf_counter()
+
 import os
+import aiohttp
 from pathlib import Path
 from dotenv import load_dotenv
 from slack_bolt.logger import get_bolt_logger
 from slack_bolt.async_app import AsyncApp
-from slack_sdk import WebClient
-from tinydb import TinyDB
+from slack_bolt.oauth.async_oauth_settings import AsyncOAuthSettings
 import logging
 from leaderboard import Leaderboard
 from settings import Settings
 from users import User
 from bests import Bests
 from monkeytype import Monkeytype
-import time
+from scheduler import RefreshScheduler
+from refresher import Refresher
+from dispatcher import ViewDispatcher
+from notifier import Notifier
+from jobs import Jobs
+from columnar import ColumnarSnapshot
+from storage import open_storage, migrate, detect_backend
+from metrics import metrics, listener_name, TimedWebClient
+from warmstart import WarmStart
+from lease import RefreshLease
+from offload import Offload
+from history import History, format_group
+from sweeper import Sweeper
+from workspaces import InstallationStore, OAuthStateStore, Workspaces
+from aiohttp import web
 import asyncio
 
 # read secrets from the local ./.env file
 env_path = Path(".") / ".env"
 load_dotenv(dotenv_path=env_path)
 
-# configure WebClient & Bolt
-token = os.environ["SLACK_BOT_TOKEN"]
-webClient = WebClient(token=token)
-app = AsyncApp(token=token, signing_secret=os.environ["SLACK_SIGNING_SECRET"])
+# how long a handler may wait on slow checks before it has to ack slack,
+# which gives up on a request after 3 seconds
+ACK_BUDGET = float(os.environ.get("ACK_BUDGET", 2))
 
 # configure Logging
 logging.basicConfig(level=logging.INFO)
 
 # initialize the DB
-db = TinyDB(os.environ["DB_PATH"])
+DB_BACKEND = os.environ.get("DB_BACKEND", "sqlite")
+DB_PATH = os.environ["DB_PATH"]
+# the TinyDB JSON file older versions kept at DB_PATH is moved here, to be
+# migrated into a SQLite database created in its place
+LEGACY_DB_PATH = f"{DB_PATH}.tinydb"
+if DB_BACKEND == "sqlite" and detect_backend(DB_PATH) == "tinydb":
+    os.replace(DB_PATH, LEGACY_DB_PATH)
+db = open_storage(
+    DB_BACKEND,
+    DB_PATH,
+    batch_size=int(os.environ.get("DB_BATCH_SIZE", 100)),
+    fsync=os.environ.get("DB_FSYNC", "1") != "0",
+)
+DB_FLUSH_INTERVAL = float(os.environ.get("DB_FLUSH_INTERVAL", 1))
+
+# several replicas can share a SQLite store, with the one holding the lease
+# running the refresh loop and the others following the changes it writes
+if "REFRESH_LEASE_PATH" in os.environ and DB_BACKEND == "tinydb":
+    raise ValueError("a TinyDB file can't be shared by replicas, use sqlite")
+CHANGE_POLL_INTERVAL = float(os.environ.get("CHANGE_POLL_INTERVAL", 2))
+
+# one-shot import of a legacy TinyDB JSON file into an empty store
+MIGRATE_FROM = os.environ.get("MIGRATE_FROM")
+if MIGRATE_FROM is None and DB_BACKEND == "sqlite" and os.path.exists(LEGACY_DB_PATH):
+    MIGRATE_FROM = LEGACY_DB_PATH
+if MIGRATE_FROM is not None and not db.tables():
+    migrate(open_storage("tinydb", MIGRATE_FROM), db)
 
-# configure utility classes
 logger = get_bolt_logger(AsyncApp)
-bests = Bests(db)
-leaderboard = Leaderboard(db, bests, app.client, logger)
-settings = Settings(db, app.client, logger)
-users = User(db, app.client, logger)
-monkeytype = Monkeytype()
+
+# configure Bolt. with a client id the app is installed in any number of
+# workspaces through OAuth, otherwise it runs in the workspace of its bot token
+if "SLACK_CLIENT_ID" in os.environ:
+    installation_store = InstallationStore(db, logger)
+    workspaces = Workspaces(logger, installation_store=installation_store)
+    app = AsyncApp(
+        client=TimedWebClient(),
+        signing_secret=os.environ["SLACK_SIGNING_SECRET"],
+        oauth_settings=AsyncOAuthSettings(
+            client_id=os.environ["SLACK_CLIENT_ID"],
+            client_secret=os.environ["SLACK_CLIENT_SECRET"],
+            scopes=os.environ.get("SLACK_SCOPES", "commands,chat:write").split(","),
+            installation_store=installation_store,
+            installation_store_bot_only=True,
+            state_store=OAuthStateStore(db, logger),
+        ),
+    )
+else:
+    workspaces = Workspaces(
+        logger, client=TimedWebClient(token=os.environ["SLACK_BOT_TOKEN"])
+    )
+    app = AsyncApp(
+        client=workspaces.client,
+        signing_secret=os.environ["SLACK_SIGNING_SECRET"],
+    )
+
+# configure utility classes
+# where the CPU-bound part of refreshing runs: inline, thread or process
+offload = Offload(
+    os.environ.get("OFFLOAD_MODE", "inline"),
+    workers=int(os.environ["OFFLOAD_WORKERS"])
+    if "OFFLOAD_WORKERS" in os.environ
+    else None,
+)
+# an optional append-only log of personal best changes
+history = (
+    History(
+        os.environ["HISTORY_PATH"],
+        logger,
+        segment_size=int(os.environ.get("HISTORY_SEGMENT_SIZE", 1 << 20)),
+        retention=float(os.environ.get("HISTORY_RETENTION", 90 * 86400)),
+    )
+    if "HISTORY_PATH" in os.environ
+    else None
+)
+# seconds between columnar snapshots when there's no warm start to save them
+SNAPSHOT_INTERVAL = float(os.environ.get("BESTS_COLUMNS_INTERVAL", 300))
+DIGEST_INTERVAL = float(os.environ.get("DIGEST_INTERVAL", 7 * 86400))
+monkeytype = Monkeytype(
+    concurrency=int(os.environ.get("MONKEYTYPE_CONCURRENCY", 10)),
+    timeout=float(os.environ.get("MONKEYTYPE_TIMEOUT", 10)),
+    retries=int(os.environ.get("MONKEYTYPE_RETRIES", 3)),
+    cache_size=int(os.environ.get("PROFILE_CACHE_SIZE", 1000)),
+    cache_ttl=float(os.environ.get("PROFILE_CACHE_TTL", 30)),
+    offload=offload,
+)
+# an optional columnar snapshot of the personal bests for fast restarts
+bests = Bests(
+    db,
+    monkeytype,
+    snapshot=ColumnarSnapshot(os.environ["BESTS_COLUMNS_PATH"])
+    if "BESTS_COLUMNS_PATH" in os.environ
+    else None,
+    offload=offload,
+    history=history,
+    # followers catch up with the users each write changed, as long as they
+    # fell no more than this many writes behind
+    change_log=int(os.environ.get("CHANGE_LOG_SIZE", 1000))
+    if "REFRESH_LEASE_PATH" in os.environ
+    else 0,
+)
+scheduler = RefreshScheduler(
+    monkeytype,
+    window=int(os.environ.get("REFRESH_WINDOW", 60)),
+    idle=float(os.environ.get("IDLE_REFRESH_INTERVAL", 600)),
+)
+refresher = Refresher(monkeytype, bests, scheduler, logger)
+users = User(db, workspaces, logger)
+# replicas share the leaderboards table, so they can't cache the views' state
+leaderboard = Leaderboard(
+    db, bests, users, workspaces, logger, cache="REFRESH_LEASE_PATH" not in os.environ
+)
+settings = Settings(workspaces, logger)
+# one-shot move of the selections kept in their own table into the views
+if "settings" in db.tables():
+    leaderboard.adopt_settings(db.table("settings"))
+# one-shot move of the channels registered before OAuth installs into a team
+if workspaces.multi and "LEGACY_TEAM_ID" in os.environ:
+    users.adopt_channels(os.environ["LEGACY_TEAM_ID"])
+dispatcher = ViewDispatcher(
+    leaderboard,
+    bests,
+    users,
+    logger,
+    debounce=float(os.environ.get("VIEW_UPDATE_DEBOUNCE", 5)),
+)
+bests.subscribe(dispatcher.notify)
+metrics.gauge("open_leaderboard_views", lambda: len(leaderboard.get_views()))
+metrics.gauge("registered_users", lambda: len(users.get_all()))
+jobs = Jobs(logger, concurrency=int(os.environ.get("JOB_CONCURRENCY", 4)))
+notifier = Notifier(
+    workspaces,
+    logger,
+    concurrency=int(os.environ.get("SLACK_POST_CONCURRENCY", 4)),
+)
+
+# snapshots what a restart would otherwise refetch, when a path is configured
+warm_start = (
+    WarmStart(
+        os.environ["WARM_START_PATH"],
+        bests,
+        monkeytype,
+        scheduler,
+        logger,
+        interval=float(os.environ.get("WARM_START_INTERVAL", 300)),
+    )
+    if "WARM_START_PATH" in os.environ
+    else None
+)
+# expires views slack never said were closed and compacts the store
+sweeper = Sweeper(
+    db,
+    leaderboard,
+    logger,
+    ttl=float(os.environ.get("VIEW_TTL", 86400)),
+    interval=float(os.environ.get("SWEEP_INTERVAL", 600)),
+    threshold=int(os.environ.get("COMPACT_THRESHOLD", 1000)),
+)
+lease = (
+    RefreshLease(os.environ["REFRESH_LEASE_PATH"], logger)
+    if "REFRESH_LEASE_PATH" in os.environ
+    else None
+)
+
+
+@app.middleware
+async def measure_latency(body, next):  # pylint: disable=redefined-builtin
+    "records how long each listener takes to handle a request"
+    with metrics.time("slack_handler_seconds", listener=listener_name(body)):
+        await next()
+
+
+async def serve_metrics(_):
+    "exposes the app's metrics for prometheus to scrape"
+    return web.Response(text=metrics.render(), content_type="text/plain")
 
 
 # opens the leaderboard
 @app.command("/monkeytype")
-async def open_leaderboard(ack, body, command):
+async def open_leaderboard(ack, body, command, context, respond):
     "when user clicks opens the leaderboard"
     await ack()
-    channel = command["channel_id"]
+    # channels are partitioned by team when the app has several workspaces
+    channel = workspaces.scope(context.team_id, command["channel_id"])
+    args = command.get("text", "").split()
+    if len(args) == 2 and args[0] == "unregister":
+        await unregister_user(args[1], channel, respond)
+        return
+    if len(args) >= 2 and args[0] == "register":
+        await register_from_command(args[1:], channel, body["user_id"], respond)
+        return
+    if args and args[0] == "progress" and history is not None:
+        await show_progress(args[1:], respond)
+        return
     # update_results(channel)
     trigger_id = body["trigger_id"]
+    tic = time.perf_counter()
     await leaderboard.open(channel, trigger_id)
+    if "first_leaderboard_seconds" not in metrics.gauges:
+        # the first leaderboard pays for loading the bests index
+        elapsed = time.perf_counter() - tic
+        metrics.gauge("first_leaderboard_seconds", lambda: elapsed)
+        logger.info("first leaderboard opened in %f seconds", elapsed)
 
 
 # closes the leaderboard
 @app.view_closed("leaderboard")
 async def close_leaderboard(ack, body):
-    "delete view from views and settings table"
+    "delete the view's state"
     await ack()
     view_id = body["view"]["id"]
     leaderboard.remove(view_id)
-    settings.remove(view_id)
 
 
 # open register user view
 @app.action("register")
-async def open_register_user_view(ack, body):
+async def open_register_user_view(ack, body, context):
     "when user clicks 'register a new typer'"
     await ack()
     trigger_id = body["trigger_id"]
-    await users.open(trigger_id)
+    await users.open(trigger_id, context.team_id)
 
 
 # submit user for registration
@@ -73,26 +273,38 @@ async def open_register_user_view(ack, body):
 async def register_user(ack, body):
     "when user clicks 'register'"
 
-    username = body["view"]["state"]["values"]["form"]["username"]["value"]
+    text = body["view"]["state"]["values"]["form"]["username"]["value"] or ""
+    usernames = monkeytype.split_usernames(text)
 
-    # make sure the username is valid
-    if not monkeytype.is_valid_username(username):
+    # make sure the usernames are valid
+    invalid = [u for u in usernames if not monkeytype.is_valid_username(u)]
+    if not usernames:
+        await ack(response_action="errors", errors={"form": "Enter a username!"})
+        return
+    if invalid:
         await ack(
-            response_action="errors", errors={"form": "That's not a valid username!"}
+            response_action="errors",
+            errors={"form": f"That's not a valid username: {', '.join(invalid)}"},
         )
         return
 
-    # confirm the monkeytype profile actually exists
-    if not await monkeytype.profile_exists(username):
+    view_id = body["view"]["root_view_id"]
+    channel = leaderboard.get_channel(view_id)
+    if channel is None:
+        # the leaderboard expired while it was open
         await ack(
             response_action="errors",
-            errors={"form": f"monkeytype user '{username}' does not exist"},
+            errors={"form": "this leaderboard expired, open it again with /monkeytype"},
         )
         return
+    slack_user = body["user"]["id"]
+    if len(usernames) > 1:
+        await ack()
+        submit_bulk_registration(usernames, channel, view_id, slack_user)
+        return
 
     # check if this user is already registered in this channel
-    view_id = body["view"]["root_view_id"]
-    channel = leaderboard.get_channel(view_id)
+    username = usernames[0]
     if users.is_registered(username, channel):
         await ack(
             response_action="errors",
@@ -100,28 +312,223 @@ async def register_user(ack, body):
         )
         return
 
+    # confirm the monkeytype profile actually exists, but only wait as long as
+    # the ack budget allows. if the API is slow, the check finishes in the
+    # background job instead
+    exists = asyncio.ensure_future(monkeytype.profile_exists(username))
+    try:
+        found = await asyncio.wait_for(asyncio.shield(exists), ACK_BUDGET)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        found = None
+    if found is False:
+        await ack(
+            response_action="errors",
+            errors={"form": f"monkeytype user '{username}' does not exist"},
+        )
+        return
+
     await ack()
+
+    async def report_failure(_):
+        notifier.post(
+            channel,
+            f"something went wrong registering monkeytype user '{username}', please try again",
+            user=slack_user,
+        )
+
+    jobs.submit(
+        "register",
+        complete_registration(username, exists, channel, view_id, slack_user),
+        on_error=report_failure,
+    )
+
+
+async def complete_registration(username, exists, channel, view_id, slack_user):
+    "registers a user whose registration was acked"
+    if not await exists:
+        notifier.post(
+            channel, f"monkeytype user '{username}' does not exist", user=slack_user
+        )
+        return
+
+    # use the username as spelled on the profile so it matches its bests
+    username = (await monkeytype.get_profile(username))["data"]["name"]
+    if users.is_registered(username, channel):
+        return
+
     # register the user
-    users.register(username, channel)
+    users.register(username, channel, slack_user)
     # update bests table
     await bests.fetch_and_save(username)
     # update the leaderboard now that there's a new user
-    await leaderboard.refresh(view_id)
+    view = leaderboard.get_view(view_id)
+    if view is not None:
+        await leaderboard.show(view)
     # notify the channel
-    webClient.chat_postMessage(
-        channel=channel,
-        text=f"_crackles knuckles_ <{monkeytype.get_profile_link(username)}|{username}> has been added to the leaderboard",
+    notifier.post(
+        channel,
+        f"_crackles knuckles_ <{monkeytype.get_profile_link(username)}|{username}> has been added to the leaderboard",
+    )
+
+
+async def register_from_command(args, channel, slack_user, respond):
+    "registers the users given to /monkeytype register"
+    usernames = monkeytype.split_usernames(" ".join(args))
+    invalid = [u for u in usernames if not monkeytype.is_valid_username(u)]
+    if invalid:
+        await respond(f"that's not a valid username: {', '.join(invalid)}")
+        return
+    await respond(f"registering {len(usernames)} typers...")
+    submit_bulk_registration(usernames, channel, None, slack_user)
+
+
+def submit_bulk_registration(usernames, channel, view_id, slack_user):
+    "registers several users in a background job"
+
+    async def report_failure(_):
+        notifier.post(
+            channel,
+            "something went wrong registering those monkeytype users, please try again",
+            user=slack_user,
+        )
+
+    jobs.submit(
+        "register",
+        complete_bulk_registration(usernames, channel, view_id, slack_user),
+        on_error=report_failure,
     )
 
 
+async def complete_bulk_registration(usernames, channel, view_id, slack_user):
+    """
+    registers several users with one batch of profile fetches, one write,
+    one leaderboard refresh and one message
+    """
+    usernames = list(dict.fromkeys(usernames))
+    results = await monkeytype.get_profiles(usernames)
+    profiles, missing, failed, already = {}, [], [], []
+    for username, result in zip(usernames, results):
+        if isinstance(result, aiohttp.ClientResponseError) and result.status == 404:
+            missing.append(username)
+        elif isinstance(result, Exception):
+            failed.append(username)
+        elif result["message"] != "Profile retrieved":
+            missing.append(username)
+        # use the username as spelled on the profile so it matches its bests
+        elif users.is_registered(result["data"]["name"], channel):
+            already.append(result["data"]["name"])
+        else:
+            profiles.setdefault(result["data"]["name"], result)
+
+    # the fetched profiles are reused rather than fetched again
+    if profiles:
+        data = await bests.normalize_many(profiles.values())
+        try:
+            with db.transaction():
+                users.register_many(list(profiles), channel, slack_user)
+                bests.sync(data, users=list(profiles))
+        except Exception:
+            # the in-memory indexes were updated before the writes were rolled
+            # back, so they're rebuilt from what the store actually holds
+            users.build_index()
+            bests.build_index()
+            raise
+
+    view = leaderboard.get_view(view_id) if view_id and profiles else None
+    if view is not None:
+        await leaderboard.show(view)
+
+    lines = []
+    if profiles:
+        links = ", ".join(f"<{monkeytype.get_profile_link(u)}|{u}>" for u in profiles)
+        lines.append(
+            f"_crackles knuckles_ {len(profiles)} typers have been added to the leaderboard: {links}"
+        )
+    if already:
+        lines.append(f"already registered: {', '.join(already)}")
+    if missing:
+        lines.append(f"monkeytype users that don't exist: {', '.join(missing)}")
+    if failed:
+        lines.append(f"couldn't be checked, please try again: {', '.join(failed)}")
+    notifier.post(channel, "\n".join(lines))
+
+
+async def unregister_user(username, channel, respond):
+    "removes a user from a channel's leaderboard"
+    if not users.is_registered(username, channel):
+        await respond(f"monkeytype user '{username}' isn't registered in this channel")
+        return
+    if users.unregister(username, channel):
+        # nobody is tracking this user anymore, so forget their bests
+        bests.sync([], users=[username])
+    await respond(f"monkeytype user '{username}' has been removed from the leaderboard")
+
+
+async def show_progress(args, respond):
+    "tells how a user's personal bests improved over the last days"
+    if not args or len(args) > 2 or (len(args) == 2 and not args[1].isdigit()):
+        await respond("usage: /monkeytype progress <username> [days]")
+        return
+    username, days = args[0], int(args[1]) if len(args) == 2 else 7
+    history.catch_up()
+    progress = history.get_progress(username, days)
+    if not progress:
+        await respond(f"no new personal bests for '{username}' in the last {days} days")
+        return
+    lines = [f"*{username}* over the last {days} days:"]
+    lines += [
+        f"{format_group(group)}: {before} → {now} wpm (+{now - before:.2f})"
+        for group, before, now in progress
+    ]
+    await respond("\n".join(lines))
+
+
+# move between pages of the leaderboard
+@app.action("previous_page")
+async def previous_page(ack, body):
+    "when user clicks the previous page button"
+    await ack()
+    await leaderboard.turn_page(body["view"]["root_view_id"], -1)
+
+
+@app.action("next_page")
+async def next_page(ack, body):
+    "when user clicks the next page button"
+    await ack()
+    await leaderboard.turn_page(body["view"]["root_view_id"], 1)
+
+
+@app.action("my_rank")
+async def jump_to_my_rank(ack, body):
+    "when user clicks the jump to my rank button"
+    await ack()
+    view_id = body["view"]["root_view_id"]
+    slack_user = body["user"]["id"]
+    usernames = users.get_registered_by(slack_user)
+    if await leaderboard.jump_to(view_id, usernames):
+        return
+    channel = leaderboard.get_channel(view_id)
+    if channel is None:
+        # the leaderboard expired while it was open
+        return
+    if usernames:
+        text = "none of the typers you registered are on this leaderboard"
+    else:
+        text = "you haven't registered any typers yet, register one to find your rank"
+    notifier.post(channel, text, user=slack_user)
+
+
 # open settings
 @app.action("settings")
-async def open_settings(ack, body):
+async def open_settings(ack, body, context):
     "when user clicks the settings button"
     await ack()
-    view_id = body["view"]["root_view_id"]
+    view = leaderboard.get_view(body["view"]["root_view_id"])
+    if view is None:
+        # the leaderboard expired while it was open, there's nothing to set
+        return
     trigger_id = body["trigger_id"]
-    await settings.open(view_id, trigger_id)
+    await settings.open(trigger_id, view.get("settings"), context.team_id)
 
 
 # submits settings
@@ -132,38 +539,180 @@ async def submit_settings(ack, body):
     view_id = body["view"]["root_view_id"]
     values = body["view"]["state"]["values"]
     fragment = settings.build_fragment(values)
-    await leaderboard.update(view_id, fragment)
-    settings.save(view_id, values)
+    # the fragment and the selections it came from are written together
+    await leaderboard.update(view_id, fragment, settings.parse(values))
+
+
+async def forget_workspace(ack, context):
+    """
+    when the app is uninstalled from a workspace, its bot and open views are
+    forgotten. its typers stay registered so a reinstall brings them back
+    """
+    await ack()
+    for view in leaderboard.get_views(context.team_id):
+        leaderboard.remove(view["view"])
+    await workspaces.uninstall(context.team_id)
+
+
+if workspaces.multi:
+    app.event("app_uninstalled")(forget_workspace)
+
+
+# the background tasks, referenced so they aren't garbage collected mid-flight
+tasks = set()
+
+
+def start_task(coro):
+    "runs a long running coroutine in the background, logging it if it dies"
+    task = asyncio.create_task(coro)
+    tasks.add(task)
+    task.add_done_callback(finish_task)
+    return task
+
+
+def finish_task(task):
+    "forgets a background task that ended, logging why it did"
+    tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(
+            "background task %s died",
+            task.get_coro().__name__,
+            exc_info=task.exception(),
+        )
 
 
 async def background_tasks(_):
     "registers long running background tasks"
-    asyncio.create_task(refresh_bests())
+    warm = warm_start is not None and warm_start.load()
+    if history is not None:
+        history.load()
+    start_task(refresh_bests())
+    start_task(dispatcher.run())
+    start_task(notifier.run())
+    start_task(flush_writes())
+    if lease is not None:
+        start_task(follow_changes())
+    elapsed = time.perf_counter() - STARTED
+    metrics.gauge("startup_seconds", lambda: elapsed)
+    logger.info("started in %f seconds (%s start)", elapsed, "warm" if warm else "cold")
+
+
+async def close_clients(_):
+    "releases the pooled connections when the server shuts down"
+    await monkeytype.close()
+    offload.close()
+    db.flush()
+    if history is not None:
+        history.close()
+    # only the refreshing replica writes the snapshots
+    if lease is not None and not lease.held:
+        return
+    if warm_start is not None:
+        warm_start.save()
+    else:
+        bests.save_snapshot()
+    if lease is not None:
+        lease.release()
+
+
+async def flush_writes():
+    "writes buffered table writes to disk on an interval"
+    while True:
+        await asyncio.sleep(DB_FLUSH_INTERVAL)
+        db.flush()
+
+
+async def save_snapshots():
+    "periodically snapshots the personal bests for fast restarts"
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        try:
+            bests.save_snapshot()
+        except OSError as e:
+            logger.warning("could not save the columnar snapshot: %s", e)
+
+
+async def post_digests():
+    "posts the most improved typers of the period to every channel"
+    if not history.digest_sent:
+        # the first period starts now
+        history.mark_digest_sent()
+    while True:
+        await asyncio.sleep(max(history.digest_sent + DIGEST_INTERVAL - time.time(), 0))
+        days = DIGEST_INTERVAL / 86400
+        for channel in users.get_channels():
+            improved = history.get_most_improved(users.get_members(channel), days)
+            if not improved:
+                continue
+            lines = [
+                f":chart_with_upwards_trend: most improved typers of the last {days:g} days"
+            ]
+            lines += [
+                f"{rank}. <{monkeytype.get_profile_link(username)}|{username}> "
+                f"{format_group(group)}: {before} → {now} wpm (+{now - before:.2f})"
+                for rank, (username, group, before, now) in enumerate(improved, 1)
+            ]
+            notifier.post(channel, "\n".join(lines))
+        history.mark_digest_sent()
+
+
+async def follow_changes():
+    "keeps this replica's indexes in step with the tables other replicas write"
+    while True:
+        await asyncio.sleep(CHANGE_POLL_INTERVAL)
+        try:
+            if bests.reload_if_changed():
+                logger.debug("reloaded personal bests written by another replica")
+            if users.reload_if_changed():
+                logger.debug("reloaded users written by another replica")
+        except Exception:  # pylint: disable=broad-except
+            # the store may be locked by a long write, the next poll catches up
+            logger.exception("could not follow the changes of other replicas")
 
 
 async def refresh_bests():
     "periodically refresh the user personal bests data"
+    # with several replicas only the one holding the lease refreshes
+    if lease is not None:
+        await lease.acquire()
+    # rewriting the snapshot stalls the loop, so it's only taken on an interval
+    if warm_start is not None:
+        start_task(warm_start.run())
+    elif bests.snapshot is not None:
+        start_task(save_snapshots())
+    if history is not None:
+        history.catch_up()
+        history.writable = True
+        start_task(post_digests())
+    start_task(sweeper.run())
+    # after a warm start, users fetched within the last window are still fresh
+    max_age = scheduler.window
     while True:
         tic = time.perf_counter()
-        # get every registered users monkeytype profile
-        u = users.get_all()
-        profiles = await monkeytype.get_profiles(u)
-
-        # get personal best data for each user
-        data = []
-        for profile in profiles:
-            data += bests.normalize_profile_data(profile)
-
-        # update the bests table
-        bests.overwrite(data)
+        try:
+            # decide who to refresh this window and how fast, then spread the
+            # profile fetches over the window
+            active = users.get_in_channels(leaderboard.get_open_channels())
+            results = await refresher.refresh(users.get_all(), active, max_age=max_age)
+            max_age = None
+            logger.info(
+                "refreshed personal bests for %s users in %f seconds (%s inserted, %s updated, %s deleted)",
+                len(results),
+                time.perf_counter() - tic,
+                sum(r["inserted"] for r in results),
+                sum(r["updated"] for r in results),
+                sum(r["deleted"] for r in results),
+            )
+        except Exception:  # pylint: disable=broad-except
+            # a failed cycle is retried in the next window
+            logger.exception("refresh cycle failed")
         toc = time.perf_counter()
-        logger.info(
-            "refreshed personal bests for %s users in %f seconds, will refresh again in 60 seconds", len(u), toc - tic
-        )
-        await asyncio.sleep(60)
+        await asyncio.sleep(max(scheduler.window - (toc - tic), 0))
 
 
 if __name__ == "__main__":
     server = app.server(port=5000)
+    server.web_app.router.add_get("/metrics", serve_metrics)
     server.web_app.on_startup.append(background_tasks)
+    server.web_app.on_cleanup.append(close_clients)
     server.start()
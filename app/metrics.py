@@ -0,0 +1,108 @@
+import time
+from contextlib import contextmanager
+from slack_sdk.web.async_client import AsyncWebClient
+
+
+class Metrics:
+    "collects histograms, counters and gauges and renders them for prometheus"
+
+    # seconds, from a fast in-memory lookup to a slow API call
+    default_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        # name -> (buckets, labels -> [bucket counts, sum, count])
+        self.histograms = {}
+        # name -> labels -> value
+        self.counters = {}
+        # name -> labels -> callback returning the current value
+        self.gauges = {}
+
+    def observe(self, name, value, buckets=None, **labels):
+        "records a value in a histogram"
+        bounds, series = self.histograms.setdefault(
+            name, (buckets or self.default_buckets, {})
+        )
+        key = tuple(sorted(labels.items()))
+        counts = series.setdefault(key, [[0] * len(bounds), 0, 0])
+        for idx, bound in enumerate(bounds):
+            if value <= bound:
+                counts[0][idx] += 1
+        counts[1] += value
+        counts[2] += 1
+
+    @contextmanager
+    def time(self, name, **labels):
+        "records how long the block took in a histogram"
+        tic = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - tic, **labels)
+
+    def increment(self, name, amount=1, **labels):
+        "adds to a counter"
+        series = self.counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + amount
+
+    def gauge(self, name, callback, **labels):
+        "registers a gauge whose value is read from the callback when scraped"
+        series = self.gauges.setdefault(name, {})
+        series[tuple(sorted(labels.items()))] = callback
+
+    def render(self):
+        "renders every metric in the prometheus text exposition format"
+        lines = []
+        for name, (bounds, series) in self.histograms.items():
+            lines.append(f"# TYPE {name} histogram")
+            for key, (counts, total, count) in series.items():
+                for bound, bucket in zip(bounds, counts):
+                    le = self.format_labels(key + (("le", bound),))
+                    lines.append(f"{name}_bucket{le} {bucket}")
+                inf = self.format_labels(key + (("le", "+Inf"),))
+                lines.append(f"{name}_bucket{inf} {count}")
+                lines.append(f"{name}_sum{self.format_labels(key)} {total}")
+                lines.append(f"{name}_count{self.format_labels(key)} {count}")
+        for name, series in self.counters.items():
+            lines.append(f"# TYPE {name} counter")
+            for key, value in series.items():
+                lines.append(f"{name}{self.format_labels(key)} {value}")
+        for name, series in self.gauges.items():
+            lines.append(f"# TYPE {name} gauge")
+            for key, callback in series.items():
+                lines.append(f"{name}{self.format_labels(key)} {callback()}")
+        return "\n".join(lines) + "\n"
+
+    def format_labels(self, key):
+        'formats label pairs as {name="value",...}'
+        if not key:
+            return ""
+        pairs = ",".join(f'{label}="{self.escape(value)}"' for label, value in key)
+        return "{" + pairs + "}"
+
+    def escape(self, value):
+        "escapes a label value"
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class TimedWebClient(AsyncWebClient):
+    "a slack client that records the latency of every API call"
+
+    async def api_call(self, api_method, **kwargs):
+        with metrics.time("slack_api_request_seconds", method=api_method):
+            return await super().api_call(api_method, **kwargs)
+
+
+def listener_name(body):
+    "names the command, action or view a slack request is meant for"
+    if "command" in body:
+        return body["command"]
+    if body.get("type") == "block_actions":
+        return body["actions"][0]["action_id"]
+    if "view" in body:
+        return body["view"].get("callback_id", "unknown")
+    return body.get("type", "unknown")
+
+
+# the metrics of this process
+metrics = Metrics()
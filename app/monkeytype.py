@@ -1,52 +1,235 @@
 import re
 import asyncio
 import aiohttp
+import hashlib
+import json
 import os
+import time
+from collections import OrderedDict
+from metrics import metrics
+from offload import Offload
 
 
 class Monkeytype:
-    "represents the monkeytype API"
+    """
+    represents the monkeytype API
 
-    def __init__(self):
+    a single instance should be shared by the whole app so that every request
+    goes through one pooled session and the same concurrency limit
+    """
+
+    # responses worth retrying because they're expected to be temporary
+    retry_statuses = {429, 500, 502, 503, 504}
+
+    def __init__(
+        self,
+        concurrency=10,
+        timeout=10,
+        retries=3,
+        backoff=1,
+        api_url="https://api.monkeytype.com",
+        cache_size=1000,
+        cache_ttl=30,
+        offload=None,
+    ):
         self.ape_key = os.environ["APE_KEY"]
+        self.api_url = api_url
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.session = None
+        # the most recent rate limit reported by the API
+        self.rate_limit = None
+        self.cache = ProfileCache(size=cache_size, ttl=cache_ttl)
+        # where responses are decoded, inline on the event loop by default
+        self.offload = offload if offload is not None else Offload()
+
+    def get_session(self):
+        "returns the shared session, creating it on first use"
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.concurrency, keepalive_timeout=60
+                ),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"Authorization": f"ApeKey {self.ape_key}"},
+            )
+        return self.session
+
+    async def close(self):
+        "closes the shared session"
+        if self.session is not None:
+            await self.session.close()
+
+    @staticmethod
+    def split_usernames(text):
+        "splits usernames separated by whitespace or commas"
+        return [username for username in re.split(r"[\s,]+", text) if username]
 
     def is_valid_username(self, username):
         "determines if a monkeytype username is valid"
         pattern = re.compile("^[a-zA-Z0-9_.-]*$")
         return bool(pattern.match(username))
 
-    async def get_profile(self, session=None, username=None):
-        "fetches a user's profile"
-        # create a session if one wasn't provided
-        should_close = False
-        if session is None:
-            session = aiohttp.ClientSession()
-            should_close = True
-
-        # get the profile
-        resp = await session.get(
-            f"https://api.monkeytype.com/users/{username}/profile",
-            headers={"Authorization": f"ApeKey {self.ape_key}"},
+    async def get_profile(self, username):
+        """
+        fetches a user's profile, serving it from the cache while it's fresh
+        and revalidating it with a conditional request once it's not
+        """
+        entry = self.cache.get(username)
+        if entry is not None and self.cache.is_fresh(entry):
+            return entry["profile"]
+
+        headers = {}
+        if entry is not None and entry["etag"] is not None:
+            headers["If-None-Match"] = entry["etag"]
+        if entry is not None and entry["last_modified"] is not None:
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+        status, body, resp_headers = await self.request_profile(username, headers)
+        if status == 304:
+            entry["fetched"] = time.monotonic()
+            return entry["profile"]
+
+        profile, digest = await self.offload.run(self.decode, body)
+        self.cache.put(
+            username,
+            {
+                "profile": profile,
+                "fetched": time.monotonic(),
+                "etag": resp_headers.get("ETag"),
+                "last_modified": resp_headers.get("Last-Modified"),
+                "digest": digest,
+            },
         )
-        json = await resp.json()
+        return profile
+
+    @staticmethod
+    def decode(body):
+        "decodes a profile response, then trims it and hashes its personal bests"
+        profile = Monkeytype.trim(json.loads(body))
+        return profile, Monkeytype.digest(profile)
 
-        # if session wasn't provided, close the one we created
-        if should_close:
-            await session.close()
+    @staticmethod
+    def trim(profile):
+        "keeps only the parts of a profile the app uses, so cached profiles stay small"
+        data = profile.get("data") or {}
+        return {
+            "message": profile.get("message"),
+            "data": {
+                "name": data.get("name"),
+                "personalBests": data.get("personalBests") or {},
+            },
+        }
 
-        return json
+    def get_digest(self, username):
+        "the hash of a cached profile's personal bests"
+        entry = self.cache.get(username)
+        return entry["digest"] if entry is not None else None
+
+    @staticmethod
+    def digest(profile):
+        "hashes a profile's personal bests so unchanged profiles can be skipped"
+        bests = profile.get("data", {}).get("personalBests")
+        encoded = json.dumps(bests, sort_keys=True).encode()
+        return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+
+    async def request_profile(self, username, headers):
+        """
+        requests a user's profile, retrying with exponential backoff when
+        rate limited, when the API errors or when the request times out.
+        returns the status, the undecoded body and the response headers
+        """
+        url = f"{self.api_url}/users/{username}/profile"
+        for attempt in range(self.retries + 1):
+            delay = self.backoff * 2**attempt
+            try:
+                async with self.semaphore:
+                    tic = time.perf_counter()
+                    async with self.get_session().get(url, headers=headers) as resp:
+                        metrics.observe(
+                            "monkeytype_request_seconds",
+                            time.perf_counter() - tic,
+                            status=resp.status,
+                        )
+                        self.track_rate_limit(resp.headers)
+                        if resp.status == 304:
+                            return resp.status, None, resp.headers
+                        if (
+                            resp.status not in self.retry_statuses
+                            or attempt == self.retries
+                        ):
+                            resp.raise_for_status()
+                            return resp.status, await resp.read(), resp.headers
+                        # honor the API's own idea of when to come back
+                        retry_after = resp.headers.get("Retry-After", "")
+                        if retry_after.isdigit():
+                            delay = int(retry_after)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                metrics.increment("monkeytype_request_errors_total")
+                if attempt == self.retries:
+                    raise
+            await asyncio.sleep(delay)
+
+    def track_rate_limit(self, headers):
+        "remembers how many requests are left before the rate limit resets"
+        try:
+            self.rate_limit = {
+                "limit": int(headers["X-RateLimit-Limit"]),
+                "remaining": int(headers["X-RateLimit-Remaining"]),
+                "reset": float(headers["X-RateLimit-Reset"]),
+            }
+        except (KeyError, ValueError):
+            pass
 
     async def get_profiles(self, usernames):
-        "fetches multiple user profiles"
-        async with aiohttp.ClientSession() as session:
-            tasks = [self.get_profile(session=session, username=u) for u in usernames]
-            return await asyncio.gather(*tasks)
+        """
+        fetches multiple user profiles
+        profiles that could not be fetched are returned as the raised exception
+        """
+        tasks = [self.get_profile(u) for u in usernames]
+        return await asyncio.gather(*tasks, return_exceptions=True)
 
     async def profile_exists(self, username):
         "determines if a username corresponds to an existing profile"
-        profile = await self.get_profile(username=username)
+        try:
+            profile = await self.get_profile(username)
+        except aiohttp.ClientResponseError as e:
+            if e.status == 404:
+                return False
+            raise
         return profile["message"] == "Profile retrieved"
 
-    def get_profile_link(self, username):
+    @staticmethod
+    def get_profile_link(username):
         "returns a users public profile link"
         return f"https://monkeytype.com/profile/{username}"
+
+
+class ProfileCache:
+    "a least recently used cache of fetched profiles that go stale after a ttl"
+
+    def __init__(self, size=1000, ttl=30):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, username):
+        "returns a user's cached entry, fresh or not"
+        entry = self.entries.get(username)
+        if entry is not None:
+            self.entries.move_to_end(username)
+        return entry
+
+    def put(self, username, entry):
+        "caches an entry, evicting the least recently used one when full"
+        self.entries[username] = entry
+        self.entries.move_to_end(username)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def is_fresh(self, entry):
+        "determines if an entry can be served without asking the API"
+        return time.monotonic() - entry["fetched"] < self.ttl
@@ -0,0 +1,70 @@
+import asyncio
+from slack_sdk.errors import SlackApiError
+
+
+class Notifier:
+    """
+    posts messages to channels in the background so handlers never wait on slack
+
+    messages queued for the same channel within the batch window are posted
+    as a single message, and posts that are rate limited are retried once
+    slack says it's ok to try again
+    """
+
+    def __init__(self, workspaces, logger, concurrency=4, batch_window=1, retries=3):
+        self.workspaces = workspaces
+        self.logger = logger
+        self.batch_window = batch_window
+        self.retries = retries
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.queue = asyncio.Queue()
+        self.tasks = set()
+
+    def post(self, channel, text, user=None):
+        """
+        queues a message to be posted to a channel
+        when a user is given, only that user will see the message
+        """
+        self.queue.put_nowait(((channel, user), text))
+
+    async def run(self):
+        "posts queued messages, batching them per channel and recipient"
+        while True:
+            recipient, text = await self.queue.get()
+            # give related messages a moment to arrive so they're sent together
+            await asyncio.sleep(self.batch_window)
+            batches = {recipient: [text]}
+            while not self.queue.empty():
+                recipient, text = self.queue.get_nowait()
+                batches.setdefault(recipient, []).append(text)
+            for (channel, user), texts in batches.items():
+                task = asyncio.create_task(self.send(channel, "\n".join(texts), user))
+                # keep a reference so the task isn't garbage collected mid-flight
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+    async def send(self, channel, text, user=None):
+        "posts a message, retrying when rate limited"
+        try:
+            client, channel_id = await self.workspaces.get_channel_client(channel)
+        except LookupError as e:
+            self.logger.warning("could not post to channel %s: %s", channel, e)
+            return
+        for attempt in range(self.retries + 1):
+            async with self.semaphore:
+                try:
+                    if user is None:
+                        await client.chat_postMessage(channel=channel_id, text=text)
+                    else:
+                        await client.chat_postEphemeral(
+                            channel=channel_id, user=user, text=text
+                        )
+                    return
+                except SlackApiError as e:
+                    if e.response["error"] != "ratelimited" or attempt == self.retries:
+                        self.logger.warning(
+                            "could not post to channel %s: %s", channel, e
+                        )
+                        return
+                    delay = int(e.response.headers.get("Retry-After", 1))
+            await asyncio.sleep(delay)
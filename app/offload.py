@@ -0,0 +1,36 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+class Offload:
+    """
+    runs CPU-bound work inline on the event loop, in a thread pool or in a
+    process pool, so the cost of each can be compared
+
+    work sent to a process pool must be a module-level function or static
+    method, and its arguments and result are pickled on the way
+    """
+
+    modes = ("inline", "thread", "process")
+
+    def __init__(self, mode="inline", workers=None):
+        if mode not in self.modes:
+            raise ValueError(f"unknown offload mode '{mode}'")
+        self.mode = mode
+        self.executor = None
+        if mode == "thread":
+            self.executor = ThreadPoolExecutor(workers, thread_name_prefix="offload")
+        elif mode == "process":
+            self.executor = ProcessPoolExecutor(workers)
+
+    async def run(self, func, *args):
+        "calls func with args, off the event loop unless running inline"
+        if self.executor is None:
+            return func(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def close(self):
+        "shuts the pool down"
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
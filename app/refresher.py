@@ -0,0 +1,54 @@
+import asyncio
+import aiohttp
+
+
+class Refresher:
+    """
+    runs refresh cycles: plans who to refresh, spreads their profile fetches
+    over the scheduler's window and writes the personal bests that changed
+    """
+
+    def __init__(self, monkeytype, bests, scheduler, logger):
+        self.monkeytype = monkeytype
+        self.bests = bests
+        self.scheduler = scheduler
+        self.logger = logger
+
+    async def refresh(self, usernames, active, max_age=None):
+        """
+        refreshes the users the scheduler picks for this window, returning the
+        changes written for every user whose profile was fetched
+        """
+        queue = self.scheduler.plan(usernames, active, max_age=max_age)
+        self.logger.info(
+            "refreshing %s of %s users over %s seconds at %f requests per second (rate limit: %s)",
+            len(queue),
+            len(usernames),
+            self.scheduler.window,
+            self.scheduler.rate,
+            self.monkeytype.rate_limit,
+        )
+        tasks = []
+        for username in queue:
+            await self.scheduler.acquire()
+            tasks.append(asyncio.create_task(self.refresh_user(username)))
+        return [r for r in await asyncio.gather(*tasks) if r is not None]
+
+    async def refresh_user(self, username):
+        "fetch a single user's profile and write the personal bests that changed"
+        try:
+            profile = await self.monkeytype.get_profile(username)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.logger.warning("could not fetch profile of %s: %s", username, e)
+            return None
+        self.scheduler.mark_fetched(username)
+        try:
+            changes = await self.bests.save(username, profile)
+        except Exception:  # pylint: disable=broad-except
+            # a locked store or a malformed profile only costs this user's
+            # refresh, the rest of the cycle goes on
+            self.logger.exception("could not save personal bests of %s", username)
+            return None
+        if any(changes.values()):
+            self.scheduler.mark_changed(username)
+        return changes
@@ -0,0 +1,92 @@
+import asyncio
+import math
+import time
+
+
+class RefreshScheduler:
+    """
+    paces profile refreshes across a refresh window with a token bucket so the
+    monkeytype rate limit is never exceeded, refreshing the most relevant users
+    first when the remaining budget can't cover everyone
+    """
+
+    def __init__(self, monkeytype, window=60, burst=1, recent=3600, idle=0):
+        self.monkeytype = monkeytype
+        self.window = window
+        self.burst = burst
+        self.recent = recent
+        # seconds between refreshes of users on no open leaderboard
+        self.idle = idle
+        self.rate = 1
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.last_changed = {}
+        self.last_fetched = {}
+
+    def plan(self, usernames, active, max_age=None):
+        """
+        orders the users to refresh this window and sets the request rate so
+        the fetches are spread over it. users on an open leaderboard come first,
+        then users whose bests changed recently, then whoever waited longest.
+        users fetched less than max_age seconds ago are left out, and so are
+        users on no open leaderboard fetched less than idle seconds ago
+        """
+        now = time.monotonic()
+        usernames = [
+            u
+            for u in usernames
+            if u in active or now - self.last_fetched.get(u, -math.inf) >= self.idle
+        ]
+        if max_age is not None:
+            usernames = [
+                u
+                for u in usernames
+                if now - self.last_fetched.get(u, -math.inf) >= max_age
+            ]
+        queue = sorted(
+            usernames,
+            key=lambda u: (
+                u not in active,
+                now - self.last_changed.get(u, -math.inf) > self.recent,
+                self.last_fetched.get(u, -math.inf),
+            ),
+        )
+        self.rate = max(len(queue), 1) / self.window
+        budget = self.budget()
+        if budget is not None:
+            # at least one request per window, so an exhausted limit is read
+            # again once it resets
+            self.rate = max(min(self.rate, budget), 1 / self.window)
+            queue = queue[: max(math.floor(self.rate * self.window), 1)]
+        return queue
+
+    def budget(self):
+        """
+        the request rate the remaining rate limit allows until it resets, or
+        None when there is no limit to respect, like once it has reset
+        """
+        limit = self.monkeytype.rate_limit
+        if limit is None or limit["reset"] <= time.time():
+            return None
+        return limit["remaining"] / max(limit["reset"] - time.time(), 1)
+
+    async def acquire(self):
+        "waits for a token before a request can be made"
+        while True:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def mark_fetched(self, username):
+        "records that a user's profile was just fetched"
+        self.last_fetched[username] = time.monotonic()
+
+    def mark_changed(self, username):
+        "records that a user's personal bests just changed"
+        self.last_changed[username] = time.monotonic()
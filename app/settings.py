@@ -1,6 +1,3 @@
-from tinydb import where
-
-
 class Settings:
     "represents the settings view"
 
@@ -13,18 +10,79 @@ class Settings:
         "punctuation": [],
     }
 
-    def __init__(self, db, client, logger):
-        self.table = db.table("settings")
-        self.client = client
+    # the options never change, so they are shared between renders
+    duration_option_groups = [
+        {
+            "label": {"type": "plain_text", "text": "Time"},
+            "options": [
+                {
+                    "text": {"type": "plain_text", "text": "15s"},
+                    "value": "time-15",
+                },
+                {
+                    "text": {"type": "plain_text", "text": "30s"},
+                    "value": "time-30",
+                },
+                {
+                    "text": {"type": "plain_text", "text": "60s"},
+                    "value": "time-60",
+                },
+                {
+                    "text": {"type": "plain_text", "text": "120s"},
+                    "value": "time-120",
+                },
+            ],
+        },
+        {
+            "label": {"type": "plain_text", "text": "Words"},
+            "options": [
+                {
+                    "text": {"type": "plain_text", "text": "10"},
+                    "value": "words-10",
+                },
+                {
+                    "text": {"type": "plain_text", "text": "25"},
+                    "value": "words-25",
+                },
+                {
+                    "text": {"type": "plain_text", "text": "50"},
+                    "value": "words-50",
+                },
+                {
+                    "text": {"type": "plain_text", "text": "100"},
+                    "value": "words-100",
+                },
+            ],
+        },
+    ]
+
+    difficulty_options = [
+        {
+            "text": {"type": "plain_text", "text": "normal"},
+            "value": "normal",
+        },
+        {
+            "text": {"type": "plain_text", "text": "expert"},
+            "value": "expert",
+        },
+        {
+            "text": {"type": "plain_text", "text": "master"},
+            "value": "master",
+        },
+    ]
+
+    def __init__(self, workspaces, logger):
+        self.workspaces = workspaces
         self.logger = logger
+        # rendered blocks for each combination of selections
+        self.rendered = {}
 
-    async def open(self, view_id, trigger_id):
-        "opens the settings view"
-        # check if the user changed the default settings before
-        # if they haven't, just use the defaults
-        saved = self.table.get(where("view_id") == view_id)
+    async def open(self, trigger_id, saved=None, team=None):
+        "opens the settings view with the selections saved in the leaderboard's state"
+        # if the user hasn't changed the default settings before, use the defaults
         settings = saved if saved is not None else self.defaults
-        await self.client.views_push(
+        client = await self.workspaces.get_client(team)
+        await client.views_push(
             trigger_id=trigger_id,
             view={
                 "type": "modal",
@@ -36,10 +94,21 @@ class Settings:
                     "emoji": True,
                 },
                 "submit": {"type": "plain_text", "text": "Apply"},
-                "blocks": self.build_view_blocks(settings),
+                "blocks": self.render(settings),
             },
         )
 
+    def render(self, settings):
+        "returns the view blocks for the selections, building them only once"
+        key = (
+            settings["duration"]["value"],
+            settings["difficulty"]["value"],
+            bool(settings["punctuation"]),
+        )
+        if key not in self.rendered:
+            self.rendered[key] = self.build_view_blocks(settings)
+        return self.rendered[key]
+
     def build_view_blocks(self, settings):
         "construct the view blocks using the initial options provided by settings"
         blocks = [
@@ -58,50 +127,7 @@ class Settings:
                         "emoji": True,
                         "text": "Duration",
                     },
-                    "option_groups": [
-                        {
-                            "label": {"type": "plain_text", "text": "Time"},
-                            "options": [
-                                {
-                                    "text": {"type": "plain_text", "text": "15s"},
-                                    "value": "time-15",
-                                },
-                                {
-                                    "text": {"type": "plain_text", "text": "30s"},
-                                    "value": "time-30",
-                                },
-                                {
-                                    "text": {"type": "plain_text", "text": "60s"},
-                                    "value": "time-60",
-                                },
-                                {
-                                    "text": {"type": "plain_text", "text": "120s"},
-                                    "value": "time-120",
-                                },
-                            ],
-                        },
-                        {
-                            "label": {"type": "plain_text", "text": "Words"},
-                            "options": [
-                                {
-                                    "text": {"type": "plain_text", "text": "10"},
-                                    "value": "words-10",
-                                },
-                                {
-                                    "text": {"type": "plain_text", "text": "25"},
-                                    "value": "words-25",
-                                },
-                                {
-                                    "text": {"type": "plain_text", "text": "50"},
-                                    "value": "words-50",
-                                },
-                                {
-                                    "text": {"type": "plain_text", "text": "100"},
-                                    "value": "words-100",
-                                },
-                            ],
-                        },
-                    ],
+                    "option_groups": self.duration_option_groups,
                 },
                 "label": {"type": "plain_text", "text": "Duration", "emoji": True},
             },
@@ -116,20 +142,7 @@ class Settings:
                         "emoji": True,
                         "text": "Difficulty",
                     },
-                    "options": [
-                        {
-                            "text": {"type": "plain_text", "text": "normal"},
-                            "value": "normal",
-                        },
-                        {
-                            "text": {"type": "plain_text", "text": "expert"},
-                            "value": "expert",
-                        },
-                        {
-                            "text": {"type": "plain_text", "text": "master"},
-                            "value": "master",
-                        },
-                    ],
+                    "options": self.difficulty_options,
                 },
                 "label": {"type": "plain_text", "text": "Difficulty", "emoji": True},
             },
@@ -161,27 +174,16 @@ class Settings:
 
         return blocks
 
-    def save(self, view_id, selections):
-        "persist the user's configured settings"
+    def parse(self, selections):
+        "the selections of a settings view submission, as kept in the leaderboard's state"
         values = {}
         for value in selections.values():
             values.update(value)
-        self.table.upsert(
-            {
-                "view_id": view_id,
-                "duration": values["duration"]["selected_option"],
-                "difficulty": values["difficulty"]["selected_option"],
-                "punctuation": values["punctuation"]["selected_options"],
-            },
-            where("view_id") == view_id,
-        )
-
-    def remove(self, view_id):
-        """
-        forget the user's configured settings
-        this should only happen when the root view is closed
-        """
-        self.table.remove(where("view_id") == view_id)
+        return {
+            "duration": values["duration"]["selected_option"],
+            "difficulty": values["difficulty"]["selected_option"],
+            "punctuation": values["punctuation"]["selected_options"],
+        }
 
     def build_fragment(self, selections):
         """
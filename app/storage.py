@@ -0,0 +1,454 @@
+import json
+import os
+import sqlite3
+from contextlib import contextmanager
+from tinydb import TinyDB, Query
+from tinydb.middlewares import CachingMiddleware
+from tinydb.operations import increment
+from tinydb.storages import JSONStorage
+from metrics import metrics
+
+
+# every storage backend hands out tables with the same small interface:
+#   all(), get(**match), search(**match), insert(record),
+#   insert_multiple(records), update(fields, **match), upsert(record, **match),
+#   remove(**match), truncate() and increment(field, **match), which adds one
+#   to a numeric field in place and returns its new value
+# where match is a set of top-level fields a record must be equal to.
+# storages group the writes made within `with db.transaction():` together
+
+
+def open_storage(backend, path, batch_size=1, fsync=True):
+    """
+    opens the storage backend used to persist the app's tables.
+    batch_size and fsync only apply to TinyDB, SQLite commits every write itself
+    """
+    if backend == "sqlite":
+        return SQLiteStorage(path)
+    if backend == "tinydb":
+        return TinyDBStorage(path, batch_size=batch_size, fsync=fsync)
+    raise ValueError(f"unknown storage backend '{backend}'")
+
+
+def detect_backend(path):
+    "the backend that wrote the store at path, None when there's nothing there yet"
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return None
+    with open(path, "rb") as f:
+        header = f.read(len(SQLiteStorage.header))
+    return "sqlite" if header == SQLiteStorage.header else "tinydb"
+
+
+def migrate(source, target):
+    "copies every table from one storage backend into another"
+    # all of it or none of it, so an interrupted migration can be run again
+    with target.transaction():
+        for name in source.tables():
+            target.table(name).insert_multiple(source.table(name).all())
+    target.flush()
+
+
+class Generation:
+    """
+    a counter in the meta table that's bumped every time a table is written,
+    so processes sharing the store can tell when their copy of it is stale
+
+    with a log, the keys written by each generation are kept in the changes
+    table too, so a process that fell behind can catch up with only those
+    """
+
+    def __init__(self, db, name, log=0):
+        self.table = db.table("meta")
+        self.name = name
+        # how many generations of written keys are kept, 0 keeps none
+        self.log = log
+        self.changes = db.table("changes") if log else None
+        # the generation this process last saw
+        self.value = None
+
+    def read(self):
+        "the generation currently in the store"
+        meta = self.table.get(name=self.name)
+        return meta["generation"] if meta is not None else 0
+
+    def get(self):
+        "the generation this process last saw"
+        if self.value is None:
+            self.value = self.read()
+        return self.value
+
+    def refresh(self):
+        "catches up with the generation in the store"
+        self.value = self.read()
+        return self.value
+
+    def is_stale(self):
+        "determines if another process wrote the table since it was last seen"
+        return self.value is not None and self.read() != self.value
+
+    def bump(self, keys=None):
+        """
+        records that this process just wrote the table, and which keys it
+        wrote when they're logged, returning whether the store was still at
+        the generation this process last saw. when it wasn't, the process
+        stays stale so it reloads the other writes
+        """
+        value = self.table.increment("generation", name=self.name)
+        if value is None:
+            value = 1
+            self.table.insert({"name": self.name, "generation": value})
+        if self.changes is not None:
+            # None tells readers the keys weren't known, so they reload it all
+            keys = sorted(keys) if keys is not None else None
+            self.changes.insert({"name": self.name, "generation": value, "keys": keys})
+            self.changes.remove(name=self.name, generation=value - self.log)
+        current = value - 1 == self.value
+        # when another process wrote in between, seeing this bump as current
+        # would hide that write
+        if current:
+            self.value = value
+        return current
+
+    def changed(self):
+        """
+        the keys written since the generation this process last saw, catching
+        up with the store. None when they weren't all logged, in which case
+        the process has to reload everything
+        """
+        if self.changes is None or self.value is None:
+            return None
+        latest = self.read()
+        keys = set()
+        for generation in range(self.value + 1, latest + 1):
+            change = self.changes.get(name=self.name, generation=generation)
+            if change is None or change["keys"] is None:
+                return None
+            keys.update(change["keys"])
+        self.value = latest
+        return keys
+
+
+class TimedTable:
+    "records how long every operation on a table takes"
+
+    operations = {
+        "all",
+        "get",
+        "search",
+        "insert",
+        "insert_multiple",
+        "update",
+        "upsert",
+        "remove",
+        "truncate",
+        "increment",
+    }
+
+    def __init__(self, table, name):
+        self.table = table
+        self.name = name
+
+    def __getattr__(self, attr):
+        method = getattr(self.table, attr)
+        if attr not in self.operations:
+            return method
+
+        def timed(*args, **kwargs):
+            with metrics.time(
+                "storage_operation_seconds", table=self.name, operation=attr
+            ):
+                return method(*args, **kwargs)
+
+        return timed
+
+
+class TinyDBStorage:
+    """
+    stores every table in a single TinyDB JSON document
+
+    every write rewrites the whole document, so with a batch_size above 1
+    writes are buffered in memory and the document is only written once that
+    many piled up or when flushed
+    """
+
+    def __init__(self, path, batch_size=1, fsync=True):
+        storage = JSONStorage if fsync else UnsyncedJSONStorage
+        if batch_size > 1:
+            storage = BatchingMiddleware(storage, batch_size)
+        self.db = TinyDB(path, storage=storage)
+
+    def table(self, name):
+        return TimedTable(TinyDBTable(self.db.table(name)), name)
+
+    def tables(self):
+        return self.db.tables()
+
+    @contextmanager
+    def transaction(self):
+        """
+        writes made within the block are written to disk together when writes
+        are batched. TinyDB can't roll writes back, so there's no atomicity
+        """
+        yield
+        self.flush()
+
+    def compact(self):
+        """
+        writes out buffered writes. the document is rewritten on every write,
+        so removed rows take no space to reclaim
+        """
+        self.flush()
+        return 0
+
+    def flush(self):
+        "writes the buffered writes to disk"
+        if isinstance(self.db.storage, BatchingMiddleware):
+            with metrics.time(
+                "storage_operation_seconds", table="*", operation="flush"
+            ):
+                self.db.storage.flush()
+
+
+class BatchingMiddleware(CachingMiddleware):
+    """
+    keeps the document in memory, so reads see buffered writes right away,
+    and writes it to disk once batch_size writes piled up or when flushed
+    """
+
+    def __init__(self, storage_cls, batch_size):
+        super().__init__(storage_cls)
+        self.WRITE_CACHE_SIZE = batch_size
+
+
+class UnsyncedJSONStorage(JSONStorage):
+    "a JSON storage that leaves syncing its writes to disk to the OS"
+
+    def write(self, data):
+        self._handle.seek(0)
+        self._handle.write(json.dumps(data, **self.kwargs))
+        self._handle.flush()
+        self._handle.truncate()
+
+
+class TinyDBTable:
+    "a TinyDB table"
+
+    def __init__(self, table):
+        self.table = table
+
+    def all(self):
+        return [dict(record) for record in self.table.all()]
+
+    def get(self, **match):
+        record = self.table.get(Query().fragment(match))
+        return dict(record) if record is not None else None
+
+    def search(self, **match):
+        return [dict(record) for record in self.table.search(Query().fragment(match))]
+
+    def insert(self, record):
+        self.table.insert(record)
+
+    def insert_multiple(self, records):
+        self.table.insert_multiple(records)
+
+    def update(self, fields, **match):
+        self.table.update(fields, Query().fragment(match))
+
+    def upsert(self, record, **match):
+        self.table.upsert(record, Query().fragment(match))
+
+    def remove(self, **match):
+        self.table.remove(Query().fragment(match))
+
+    def truncate(self):
+        self.table.truncate()
+
+    def increment(self, field, **match):
+        ids = self.table.update(increment(field), Query().fragment(match))
+        return self.table.get(doc_id=ids[0])[field] if ids else None
+
+
+class SQLiteStorage:
+    "stores every table in a SQLite database"
+
+    # the first bytes of every SQLite database file
+    header = b"SQLite format 3\x00"
+
+    # the fields of each table that are stored in their own indexed column
+    # so they can be looked up without decoding every record
+    indexed = {
+        "bests": (
+            "user",
+            "category",
+            "duration",
+            "difficulty",
+            "language",
+            "punctuation",
+        ),
+        "changes": ("name", "generation"),
+        "installations": ("team_id",),
+        "leaderboards": ("view",),
+        "meta": ("name",),
+        "oauth_states": ("state",),
+        "settings": ("view_id",),
+        "users": ("username",),
+    }
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # how many transactions are open, only the outermost one commits
+        self.depth = 0
+
+    def table(self, name):
+        return TimedTable(
+            SQLiteTable(self.conn, name, self.indexed.get(name, ()), self.transaction),
+            name,
+        )
+
+    @contextmanager
+    def transaction(self):
+        "commits every write made within the block at once, or none of them"
+        if self.depth:
+            # already inside a transaction, which commits when it's done
+            yield
+            return
+        self.depth += 1
+        try:
+            with self.conn:
+                # take the write lock up front, so what the block reads can't
+                # be changed by another process before the block writes
+                self.conn.execute("BEGIN IMMEDIATE")
+                yield
+        finally:
+            self.depth -= 1
+
+    def flush(self):
+        "every write is already committed"
+
+    def get_size(self):
+        "the size of the database in bytes"
+        (pages,) = self.conn.execute("PRAGMA page_count").fetchone()
+        (size,) = self.conn.execute("PRAGMA page_size").fetchone()
+        return pages * size
+
+    def compact(self):
+        "rewrites the database to give back the space held by removed rows"
+        size = self.get_size()
+        self.conn.execute("VACUUM")
+        return size - self.get_size()
+
+    def tables(self):
+        rows = self.conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"
+        ).fetchall()
+        return {name for (name,) in rows}
+
+
+class SQLiteTable:
+    """
+    a SQLite table where each record is stored as a JSON document
+    alongside indexed copies of its lookup fields
+    """
+
+    def __init__(self, conn, name, columns, transaction):
+        self.conn = conn
+        self.name = name
+        self.columns = columns
+        self.transaction = transaction
+        with self.transaction():
+            self.conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {name} "
+                f"(id INTEGER PRIMARY KEY, {''.join(c + ', ' for c in columns)}data TEXT NOT NULL)"
+            )
+            if columns:
+                self.conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS {name}_lookup ON {name} ({', '.join(columns)})"
+                )
+
+    def all(self):
+        return [json.loads(data) for (data,) in self.select("data", {})]
+
+    def get(self, **match):
+        rows = self.select("data", match, limit=1)
+        return json.loads(rows[0][0]) if rows else None
+
+    def search(self, **match):
+        return [json.loads(data) for (data,) in self.select("data", match)]
+
+    def insert(self, record):
+        self.insert_multiple([record])
+
+    def insert_multiple(self, records):
+        names = ", ".join((*self.columns, "data"))
+        params = ", ".join("?" for _ in (*self.columns, "data"))
+        with self.transaction():
+            self.conn.executemany(
+                f"INSERT INTO {self.name} ({names}) VALUES ({params})",
+                (self.row(record) for record in records),
+            )
+
+    def update(self, fields, **match):
+        rows = self.select("id, data", match)
+        sets = ", ".join(f"{column} = ?" for column in (*self.columns, "data"))
+        with self.transaction():
+            self.conn.executemany(
+                f"UPDATE {self.name} SET {sets} WHERE id = ?",
+                (
+                    (*self.row({**json.loads(data), **fields}), id)
+                    for (id, data) in rows
+                ),
+            )
+
+    def upsert(self, record, **match):
+        if self.get(**match) is None:
+            self.insert(record)
+        else:
+            self.update(record, **match)
+
+    def remove(self, **match):
+        where, params = self.where(match)
+        with self.transaction():
+            self.conn.execute(f"DELETE FROM {self.name}{where}", params)
+
+    def truncate(self):
+        with self.transaction():
+            self.conn.execute(f"DELETE FROM {self.name}")
+
+    def increment(self, field, **match):
+        where, params = self.where(match)
+        with self.transaction():
+            rows = self.conn.execute(
+                f"UPDATE {self.name} SET data = json_set(data, '$.{field}', "
+                f"json_extract(data, '$.{field}') + 1){where} "
+                f"RETURNING json_extract(data, '$.{field}')",
+                params,
+            ).fetchall()
+        return rows[0][0] if rows else None
+
+    def select(self, fields, match, limit=None):
+        "fetches the given columns of every row matching the fields"
+        where, params = self.where(match)
+        query = f"SELECT {fields} FROM {self.name}{where} ORDER BY id"
+        if limit is not None:
+            query += f" LIMIT {int(limit)}"
+        return self.conn.execute(query, params).fetchall()
+
+    def where(self, match):
+        "builds the WHERE clause for a match, preferring indexed columns"
+        clauses, params = [], []
+        for field, value in match.items():
+            # IS matches NULL against None too, where = never would
+            if field in self.columns:
+                clauses.append(f"{field} IS ?")
+            else:
+                clauses.append(f"json_extract(data, '$.{field}') IS ?")
+            params.append(value)
+        if not clauses:
+            return "", params
+        return " WHERE " + " AND ".join(clauses), params
+
+    def row(self, record):
+        "the column values persisted for a record"
+        return (*(record.get(column) for column in self.columns), json.dumps(record))
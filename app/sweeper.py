@@ -0,0 +1,59 @@
+import asyncio
+import sqlite3
+import time
+from metrics import metrics
+
+
+class Sweeper:
+    """
+    expires the leaderboard rows of views slack never said were closed, which
+    happens when a modal times out or the close event is lost, and compacts
+    the store once enough rows were expired
+    """
+
+    def __init__(
+        self,
+        db,
+        leaderboard,
+        logger,
+        ttl=86400,
+        interval=600,
+        threshold=1000,
+    ):
+        self.db = db
+        self.leaderboard = leaderboard
+        self.logger = logger
+        self.ttl = ttl
+        self.interval = interval
+        self.threshold = threshold
+        # rows expired since the store was last compacted
+        self.expired = 0
+
+    def sweep(self):
+        "expires abandoned views and compacts the store, returning what was reclaimed"
+        expired = self.leaderboard.expire(time.time() - self.ttl)
+        self.expired += len(expired)
+        reclaimed = 0
+        if self.expired >= self.threshold:
+            reclaimed = self.db.compact()
+            self.expired = 0
+
+        metrics.increment("expired_rows_total", len(expired), table="leaderboards")
+        metrics.increment("storage_reclaimed_bytes_total", reclaimed)
+        self.logger.info(
+            "expired %s leaderboard rows, reclaimed %s bytes", len(expired), reclaimed
+        )
+        return {
+            "leaderboards": len(expired),
+            "reclaimed_bytes": reclaimed,
+        }
+
+    async def run(self):
+        "sweeps on an interval"
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.sweep()
+            except sqlite3.OperationalError as e:
+                # another replica may hold a lock on the database
+                self.logger.warning("could not sweep the store: %s", e)
@@ -1,18 +1,26 @@
-from tinydb import where, Query
-from tinydb.operations import add
+from storage import Generation
 
 
 class User:
     "keeps track of registered users"
 
-    def __init__(self, db, client, logger):
+    def __init__(self, db, workspaces, logger):
+        self.db = db
         self.table = db.table("users")
-        self.client = client
+        self.workspaces = workspaces
         self.logger = logger
+        # channel -> usernames registered in it, built on first use
+        self.channels = None
+        self.versions = {}
+        # slack user -> usernames they registered, built along with channels
+        self.registrants = {}
+        # bumped whenever the users table is written
+        self.generation = Generation(db, "users")
 
-    async def open(self, trigger_id):
+    async def open(self, trigger_id, team=None):
         "opens the register new typer view"
-        await self.client.views_push(
+        client = await self.workspaces.get_client(team)
+        await client.views_push(
             trigger_id=trigger_id,
             view={
                 "title": {"type": "plain_text", "text": "Register User", "emoji": True},
@@ -27,14 +35,15 @@ class User:
                         "element": {
                             "type": "plain_text_input",
                             "action_id": "username",
+                            "multiline": True,
                             "placeholder": {
                                 "type": "plain_text",
-                                "text": "Enter your Monkeytype Username...",
+                                "text": "Enter Monkeytype usernames, one per line...",
                             },
                         },
                         "label": {
                             "type": "plain_text",
-                            "text": "Monkeytype Username",
+                            "text": "Monkeytype Usernames",
                             "emoji": True,
                         },
                     }
@@ -42,24 +51,183 @@ class User:
             },
         )
 
-    def register(self, username, channel):
+    def register(self, username, channel, registered_by):
         "add monkeytype user to users table"
-        # if this user is already known, append to participating channels
-        # otherwise, add the user to the table
-        exists = bool(self.table.get(where("username") == username))
-        if exists:
-            self.table.update(add("channels", channel), where("username") == username)
+        self.register_many([username], channel, registered_by)
+
+    def register_many(self, usernames, channel, registered_by):
+        "add several monkeytype users to the users table at once"
+        # if a user is already known, append to participating channels
+        # otherwise, add the user to the table. the check and the writes share
+        # a transaction so another replica can't write the table in between
+        with self.db.transaction():
+            self.reload_if_changed()
+            new = []
+            for username in usernames:
+                user = self.table.get(username=username)
+                if user is not None:
+                    # a concurrent registration may have added the channel
+                    # since the caller checked
+                    channels = user["channels"]
+                    if channel not in channels:
+                        channels = channels + [channel]
+                    self.table.update(
+                        {
+                            "channels": channels,
+                            "registered_by": sorted(
+                                {*user.get("registered_by", []), registered_by}
+                            ),
+                        },
+                        username=username,
+                    )
+                else:
+                    new.append(
+                        {
+                            "username": username,
+                            "channels": [channel],
+                            "registered_by": [registered_by],
+                        }
+                    )
+            if new:
+                self.table.insert_multiple(new)
+            fresh = self.generation.bump()
+        if not fresh:
+            self.build_index()
+            return
+        for username in usernames:
+            self.index_member(username, channel, True)
+            self.index_registrant(username, registered_by, True)
+
+    def unregister(self, username, channel):
+        """
+        remove monkeytype user from a channel
+        returns whether the user is no longer registered in any channel
+        """
+        with self.db.transaction():
+            self.reload_if_changed()
+            user = self.table.get(username=username)
+            if user is None:
+                return False
+            channels = [c for c in user["channels"] if c != channel]
+            if channels:
+                self.table.update({"channels": channels}, username=username)
+            else:
+                self.table.remove(username=username)
+            fresh = self.generation.bump()
+        if fresh:
+            self.index_member(username, channel, False)
+            if not channels:
+                for slack_user in user.get("registered_by", []):
+                    self.index_registrant(username, slack_user, False)
         else:
-            self.table.insert({"username": username, "channels": [channel]})
+            self.build_index()
+        return not channels
+
+    def adopt_channels(self, team):
+        """
+        keys the channels saved before OAuth installs were enabled by a team,
+        returning how many users were moved
+        """
+        moved = 0
+        for user in self.table.all():
+            channels = [
+                c if self.workspaces.is_scoped(c) else self.workspaces.scope(team, c)
+                for c in user["channels"]
+            ]
+            if channels != user["channels"]:
+                self.table.update({"channels": channels}, username=user["username"])
+                moved += 1
+        if moved:
+            self.generation.bump()
+            self.channels = None
+        return moved
+
+    def get_registered_by(self, slack_user):
+        "gets the monkeytype usernames a slack user registered"
+        if self.channels is None:
+            self.build_index()
+        return list(self.registrants.get(slack_user, ()))
 
     def is_registered(self, username, channel):
         "check if the user is registered in a channel"
-        return bool(
-            self.table.get(
-                (where("username") == username) & (Query().channels.any(channel))
-            )
-        )
+        return username in self.get_members(channel)
+
+    def get_members(self, channel):
+        "gets the usernames registered in a channel"
+        if self.channels is None:
+            self.build_index()
+        return self.channels.get(channel, frozenset())
+
+    def get_version(self, channel):
+        "the version of a channel's members, bumped whenever they change"
+        if self.channels is None:
+            self.build_index()
+        return self.versions.get(channel, 0)
+
+    def get_in_channels(self, channels):
+        "gets the usernames registered in any of the given channels"
+        return set().union(*(self.get_members(channel) for channel in channels))
+
+    def get_channels(self):
+        "gets every channel with registered users"
+        if self.channels is None:
+            self.build_index()
+        return list(self.channels)
 
     def get_all(self):
         "gets all monkeytype usernames that have been registered in any channel"
-        return [user["username"] for user in self.table.all()]
+        if self.channels is None:
+            self.build_index()
+        return list(set().union(*self.channels.values()))
+
+    def build_index(self):
+        """
+        maps every channel to the usernames registered in it, and every slack
+        user to the usernames they registered
+        """
+        # channels that no longer have members still need their version bumped
+        emptied = set(self.channels or ())
+        self.generation.refresh()
+        self.channels = {}
+        self.registrants = {}
+        for user in self.table.all():
+            for channel in user["channels"]:
+                self.index_member(user["username"], channel, True)
+            for slack_user in user.get("registered_by", []):
+                self.index_registrant(user["username"], slack_user, True)
+        for channel in emptied - set(self.channels):
+            self.versions[channel] = self.versions.get(channel, 0) + 1
+
+    def reload_if_changed(self):
+        "rebuilds the index when another replica wrote the table"
+        if self.channels is None or not self.generation.is_stale():
+            return False
+        self.build_index()
+        return True
+
+    def index_member(self, username, channel, registered):
+        "adds or removes a username from a channel's members"
+        if self.channels is None:
+            return
+        members = self.channels.get(channel, frozenset())
+        if registered:
+            members = members | {username}
+        else:
+            members = members - {username}
+        if members:
+            self.channels[channel] = members
+        else:
+            self.channels.pop(channel, None)
+        self.versions[channel] = self.versions.get(channel, 0) + 1
+
+    def index_registrant(self, username, slack_user, registered):
+        "adds or removes a username from those a slack user registered"
+        if self.channels is None:
+            return
+        usernames = self.registrants.setdefault(slack_user, set())
+        if registered:
+            usernames.add(username)
+        else:
+            usernames.discard(username)
+            if not usernames:
+                del self.registrants[slack_user]
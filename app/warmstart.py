@@ -0,0 +1,83 @@
+import asyncio
+import json
+import os
+import time
+
+
+class WarmStart:
+    """
+    snapshots the state a restart would otherwise rebuild from the monkeytype
+    API: the cached profiles, when each user was last fetched and changed, and
+    the digests of the profiles whose personal bests are in the table
+
+    timestamps are kept on the monotonic clock while running, so they're
+    written as wall clock times and converted back when the snapshot is loaded
+    """
+
+    def __init__(self, path, bests, monkeytype, scheduler, logger, interval=300):
+        self.path = path
+        self.bests = bests
+        self.monkeytype = monkeytype
+        self.scheduler = scheduler
+        self.logger = logger
+        self.interval = interval
+
+    def save(self):
+        "writes the snapshot, replacing the previous one atomically"
+        offset = time.time() - time.monotonic()
+        state = {
+            "generation": self.bests.get_generation(),
+            "saved": self.bests.saved,
+            "profiles": {
+                username: {**entry, "fetched": entry["fetched"] + offset}
+                for username, entry in self.monkeytype.cache.entries.items()
+            },
+            "last_fetched": {
+                username: fetched + offset
+                for username, fetched in self.scheduler.last_fetched.items()
+            },
+            "last_changed": {
+                username: changed + offset
+                for username, changed in self.scheduler.last_changed.items()
+            },
+        }
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.path)
+        self.bests.save_snapshot()
+
+    def load(self):
+        "restores the snapshot, returning whether there was one"
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path) as f:
+            state = json.load(f)
+        offset = time.monotonic() - time.time()
+        # profiles were written least recently used first
+        for username, entry in state["profiles"].items():
+            self.monkeytype.cache.put(
+                username, {**entry, "fetched": entry["fetched"] + offset}
+            )
+        for username, fetched in state["last_fetched"].items():
+            self.scheduler.last_fetched[username] = fetched + offset
+        for username, changed in state["last_changed"].items():
+            self.scheduler.last_changed[username] = changed + offset
+        # the digests only describe the table if it wasn't written since
+        if state["generation"] == self.bests.get_generation():
+            self.bests.saved.update(state["saved"])
+        self.logger.info(
+            "warm start restored %s cached profiles and %s fetch times",
+            len(state["profiles"]),
+            len(state["last_fetched"]),
+        )
+        return True
+
+    async def run(self):
+        "periodically saves the snapshot"
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.save()
+            except OSError as e:
+                self.logger.warning("could not save the warm start snapshot: %s", e)
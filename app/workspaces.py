@@ -0,0 +1,172 @@
+import time
+import uuid
+from slack_sdk.oauth.installation_store import Bot
+from slack_sdk.oauth.installation_store.async_installation_store import (
+    AsyncInstallationStore,
+)
+from slack_sdk.oauth.state_store.async_state_store import AsyncOAuthStateStore
+from metrics import TimedWebClient
+
+
+class InstallationStore(AsyncInstallationStore):
+    """
+    keeps the bot of every workspace the app is installed in in the
+    installations table, so every replica sharing the store can find them
+
+    only bots are kept, the app never acts on behalf of the installing user
+    """
+
+    # the fields of a bot that are saved, all of them are JSON friendly
+    fields = (
+        "app_id",
+        "enterprise_id",
+        "team_id",
+        "team_name",
+        "bot_token",
+        "bot_id",
+        "bot_user_id",
+        "bot_scopes",
+        "bot_refresh_token",
+        "bot_token_expires_at",
+        "installed_at",
+    )
+
+    def __init__(self, db, logger):
+        self.table = db.table("installations")
+        self._logger = logger
+
+    @property
+    def logger(self):
+        return self._logger
+
+    async def async_save(self, installation):
+        await self.async_save_bot(installation.to_bot())
+
+    async def async_save_bot(self, bot):
+        record = {field: getattr(bot, field) for field in self.fields}
+        self.table.upsert(record, team_id=bot.team_id)
+        self.logger.info("saved the installation of team %s", bot.team_id)
+
+    async def async_find_bot(
+        self, *, enterprise_id, team_id, is_enterprise_install=False
+    ):
+        record = self.table.get(team_id=team_id)
+        return Bot(**record) if record is not None else None
+
+    async def async_find_installation(
+        self, *, enterprise_id, team_id, user_id=None, is_enterprise_install=False
+    ):
+        # user tokens are never stored
+        return None
+
+    async def async_delete_bot(self, *, enterprise_id, team_id):
+        self.table.remove(team_id=team_id)
+
+    async def async_delete_installation(self, *, enterprise_id, team_id, user_id=None):
+        if user_id is None:
+            await self.async_delete_bot(enterprise_id=enterprise_id, team_id=team_id)
+
+    async def async_delete_all(self, *, enterprise_id, team_id):
+        await self.async_delete_bot(enterprise_id=enterprise_id, team_id=team_id)
+
+
+class OAuthStateStore(AsyncOAuthStateStore):
+    """
+    keeps the states of the OAuth flows in progress in the oauth_states table,
+    so a flow started on one replica can finish on another
+    """
+
+    def __init__(self, db, logger, expiration=600):
+        self.table = db.table("oauth_states")
+        self._logger = logger
+        self.expiration = expiration
+
+    @property
+    def logger(self):
+        return self._logger
+
+    async def async_issue(self, *args, **kwargs):
+        # flows are rare, so abandoned ones are dropped as new ones start
+        for row in self.table.all():
+            if time.time() - row["issued"] >= self.expiration:
+                self.table.remove(state=row["state"])
+        state = str(uuid.uuid4())
+        self.table.insert({"state": state, "issued": time.time()})
+        return state
+
+    async def async_consume(self, state):
+        row = self.table.get(state=state)
+        if row is None:
+            return False
+        self.table.remove(state=state)
+        return time.time() - row["issued"] < self.expiration
+
+
+class Workspaces:
+    """
+    hands out the slack client of each workspace and the keys its channels
+    are stored under
+
+    with a single bot token every request goes through one client and
+    channels are keyed by their id, like they always were. with OAuth installs
+    each team's bot token is looked up in the installation store and channels
+    are keyed by team too, which partitions the users, views and settings of
+    every workspace
+    """
+
+    def __init__(self, logger, client=None, installation_store=None):
+        self.logger = logger
+        self.client = client
+        self.installation_store = installation_store
+        # bot token -> client, so a reinstall or rotated token gets a new one
+        self.clients = {}
+
+    @property
+    def multi(self):
+        "whether the app is installed through OAuth"
+        return self.installation_store is not None
+
+    def scope(self, team, channel):
+        "the key a team's channel is stored under"
+        return f"{team}:{channel}" if self.multi else channel
+
+    def split(self, key):
+        "the team and channel id of a channel key"
+        if not self.multi:
+            return None, key
+        team, _, channel = key.rpartition(":")
+        return team or None, channel
+
+    def is_scoped(self, key):
+        "whether a channel key names its team"
+        return ":" in key
+
+    async def get_client(self, team):
+        "the client acting as the app's bot in a team"
+        if not self.multi:
+            return self.client
+        bot = await self.installation_store.async_find_bot(
+            enterprise_id=None, team_id=team
+        )
+        if bot is None:
+            raise LookupError(f"the app isn't installed in team {team}")
+        client = self.clients.get(bot.bot_token)
+        if client is None:
+            client = TimedWebClient(token=bot.bot_token)
+            self.clients[bot.bot_token] = client
+        return client
+
+    async def get_channel_client(self, key):
+        "the client of the team a channel key belongs to, and the channel id"
+        team, channel = self.split(key)
+        return await self.get_client(team), channel
+
+    async def uninstall(self, team):
+        "forgets a team's bot once the app was uninstalled from it"
+        bot = await self.installation_store.async_find_bot(
+            enterprise_id=None, team_id=team
+        )
+        if bot is not None:
+            self.clients.pop(bot.bot_token, None)
+        await self.installation_store.async_delete_bot(enterprise_id=None, team_id=team)
+        self.logger.info("the app was uninstalled from team %s", team)
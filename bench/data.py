@@ -0,0 +1,67 @@
+import random
+
+# the personal best groups a synthetic profile draws from
+categories = {
+    "time": ("15", "30", "60", "120"),
+    "words": ("10", "25", "50", "100"),
+}
+difficulties = ("normal", "expert", "master")
+languages = ("english", "english_1k")
+
+
+def make_username(idx):
+    "a deterministic monkeytype username"
+    return f"typer_{idx:06d}"
+
+
+def make_profile(username, bests, rng):
+    "builds a profile response shaped like the monkeytype API's with some personal bests"
+    personal_bests = {category: {} for category in categories}
+    for _ in range(bests):
+        category = rng.choice(tuple(categories))
+        duration = rng.choice(categories[category])
+        wpm = round(rng.uniform(30, 200), 2)
+        personal_bests[category].setdefault(duration, []).append(
+            {
+                "acc": round(rng.uniform(85, 100), 2),
+                "consistency": round(rng.uniform(50, 90), 2),
+                "difficulty": rng.choice(difficulties),
+                "lazyMode": rng.random() < 0.1,
+                "language": rng.choice(languages),
+                "punctuation": rng.random() < 0.3,
+                "raw": round(wpm * rng.uniform(1, 1.1), 2),
+                "wpm": wpm,
+                "timestamp": rng.randint(1_600_000_000_000, 1_700_000_000_000),
+            }
+        )
+    return {
+        "message": "Profile retrieved",
+        "data": {"name": username, "personalBests": personal_bests},
+    }
+
+
+def make_profiles(users, bests, seed=0):
+    "builds a profile for each of the synthetic users"
+    rng = random.Random(seed)
+    return {
+        make_username(idx): make_profile(make_username(idx), bests, rng)
+        for idx in range(users)
+    }
+
+
+def bump_profiles(profiles, share, seed=1):
+    "improves a personal best of a share of the profiles, as if they set a new PB"
+    rng = random.Random(seed)
+    for username in rng.sample(sorted(profiles), int(len(profiles) * share)):
+        personal_bests = profiles[username]["data"]["personalBests"]
+        best = next(
+            (
+                best
+                for durations in personal_bests.values()
+                for bests in durations.values()
+                for best in bests
+            ),
+            None,
+        )
+        if best is not None:
+            best["wpm"] = round(best["wpm"] + 1, 2)
@@ -0,0 +1,106 @@
+import asyncio
+import copy
+import itertools
+import time
+from aiohttp import web
+
+
+class FakeMonkeytype:
+    "a local stand-in for the monkeytype profile API"
+
+    def __init__(self, profiles, latency=0.0, rate_limit=None, window=60):
+        self.profiles = profiles
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.window = window
+        self.reset = time.time() + window
+        self.used = 0
+        self.requests = 0
+        self.runner = None
+        self.url = None
+
+    async def start(self):
+        "serves the API on a free local port"
+        app = web.Application()
+        app.router.add_get("/users/{username}/profile", self.get_profile)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def get_profile(self, request):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        headers = {}
+        if self.rate_limit is not None:
+            if time.time() >= self.reset:
+                self.reset = time.time() + self.window
+                self.used = 0
+            self.used += 1
+            headers = {
+                "X-RateLimit-Limit": str(self.rate_limit),
+                "X-RateLimit-Remaining": str(max(self.rate_limit - self.used, 0)),
+                "X-RateLimit-Reset": str(self.reset),
+            }
+            if self.used > self.rate_limit:
+                headers["Retry-After"] = str(int(self.reset - time.time()) + 1)
+                return web.json_response(
+                    {"message": "Rate limit exceeded"}, status=429, headers=headers
+                )
+
+        profile = self.profiles.get(request.match_info["username"])
+        if profile is None:
+            return web.json_response(
+                {"message": "User not found"}, status=404, headers=headers
+            )
+        # hand out a copy, just like a real response would be decoded fresh
+        return web.json_response(copy.deepcopy(profile), headers=headers)
+
+
+class FakeSlack:
+    "a local stand-in for the slack web API that records the calls it receives"
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = []
+        self.view_ids = itertools.count()
+        self.runner = None
+        self.url = None
+
+    async def start(self):
+        "serves the API on a free local port"
+        app = web.Application()
+        app.router.add_post("/api/{method}", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}/api/"
+        return self
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        body = await request.read()
+        self.calls.append({"method": method, "bytes": len(body)})
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method in ("views.open", "views.update", "views.push"):
+            view_id = f"V{next(self.view_ids)}"
+            return web.json_response({"ok": True, "view": {"id": view_id}})
+        return web.json_response({"ok": True})
+
+    def count(self, method):
+        "how many times an API method was called"
+        return sum(1 for call in self.calls if call["method"] == method)
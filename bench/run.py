@@ -0,0 +1,402 @@
+"""
+benchmarks the refresh cycle, leaderboard rendering and interaction latency
+against local stand-ins for the monkeytype and slack APIs
+
+    python bench/run.py --users 1000 --bests 20 --output results.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+os.environ.setdefault("APE_KEY", "benchmark")
+
+# pylint: disable=wrong-import-position
+from slack_sdk.web.async_client import AsyncWebClient
+from bests import Bests
+from columnar import ColumnarSnapshot
+from leaderboard import Leaderboard
+from monkeytype import Monkeytype
+from offload import Offload
+from refresher import Refresher
+from scheduler import RefreshScheduler
+from storage import open_storage
+from users import User
+from warmstart import WarmStart
+from workspaces import Workspaces
+from data import make_profiles, bump_profiles
+from fakes import FakeMonkeytype, FakeSlack
+
+CHANNEL = "C_BENCH"
+
+
+def summarize(samples):
+    "summarizes latency samples in milliseconds"
+    samples = sorted(samples)
+    return {
+        "count": len(samples),
+        "mean_ms": statistics.fmean(samples) * 1000,
+        "p50_ms": samples[len(samples) // 2] * 1000,
+        "p99_ms": samples[min(int(len(samples) * 0.99), len(samples) - 1)] * 1000,
+        "max_ms": samples[-1] * 1000,
+    }
+
+
+class Bench:
+    "wires the app's classes to the fake APIs and a scratch database"
+
+    def __init__(self, args, profiles, monkeytype_api, slack_api, directory):
+        self.args = args
+        self.directory = directory
+        self.profiles = profiles
+        self.monkeytype_api = monkeytype_api
+        self.slack_api = slack_api
+        self.logger = logging.getLogger("bench")
+        self.db = db = open_storage(
+            args.backend,
+            os.path.join(directory, f"bench.{args.backend}"),
+            batch_size=args.db_batch_size,
+        )
+        self.offload = Offload(args.offload, workers=args.offload_workers)
+        self.monkeytype = Monkeytype(
+            concurrency=args.concurrency,
+            api_url=monkeytype_api.url,
+            backoff=0.1,
+            cache_ttl=0,
+            offload=self.offload,
+        )
+        self.client = AsyncWebClient(token="xoxb-bench", base_url=slack_api.url)
+        self.workspaces = Workspaces(self.logger, client=self.client)
+        self.bests = Bests(db, self.monkeytype, offload=self.offload)
+        # the app's own refresh path, with the window shortened to the bench's
+        self.refresher = Refresher(
+            self.monkeytype,
+            self.bests,
+            RefreshScheduler(self.monkeytype, window=args.refresh_window),
+            self.logger,
+        )
+        self.users = User(db, self.workspaces, self.logger)
+        self.leaderboard = Leaderboard(
+            db, self.bests, self.users, self.workspaces, self.logger
+        )
+        for username in profiles:
+            self.users.register(username, CHANNEL, "U_BENCH")
+
+    async def refresh(self):
+        "one refresh cycle over every registered user, through the app's refresher"
+        lags = []
+        monitor = asyncio.create_task(self.monitor_loop(lags))
+        tic = time.perf_counter()
+        results = await self.refresher.refresh(self.users.get_all(), set())
+        seconds = time.perf_counter() - tic
+        changes = {
+            change: sum(r[change] for r in results)
+            for change in ("inserted", "updated", "deleted")
+        }
+        monitor.cancel()
+        return {"seconds": seconds, **changes, "loop_lag": summarize(lags or [0])}
+
+    async def monitor_loop(self, lags, interval=0.01):
+        "records how late the event loop wakes up, a stand-in for handler latency"
+        while True:
+            tic = time.perf_counter()
+            await asyncio.sleep(interval)
+            lags.append(time.perf_counter() - tic - interval)
+
+    async def scenario_refresh(self):
+        "refresh cycle time from an empty table, with no changes and with some changes"
+        results = {"cold": await self.refresh(), "unchanged": await self.refresh()}
+        bump_profiles(self.profiles, self.args.changed)
+        results["changed"] = await self.refresh()
+        results["requests"] = self.monkeytype_api.requests
+        return results
+
+    async def scenario_render(self):
+        "leaderboard render time for the default filters, uncached and cached"
+        fragment = self.leaderboard.default_query
+        repeat = self.args.repeat
+        uncached, cached, lookups = [], [], []
+        for _ in range(repeat):
+            tic = time.perf_counter()
+            blocks = self.leaderboard.build_view_blocks(fragment, CHANNEL)
+            uncached.append(time.perf_counter() - tic)
+            tic = time.perf_counter()
+            self.leaderboard.render(fragment, CHANNEL)
+            cached.append(time.perf_counter() - tic)
+            tic = time.perf_counter()
+            self.bests.get(fragment)
+            lookups.append(time.perf_counter() - tic)
+
+        normalize = []
+        for profile in list(self.profiles.values())[:repeat]:
+            tic = time.perf_counter()
+            list(self.bests.normalize_profile_data(json.loads(json.dumps(profile))))
+            normalize.append(time.perf_counter() - tic)
+
+        return {
+            **self.columnar(),
+            "results": len(self.bests.get(fragment)),
+            "blocks": len(blocks),
+            "build_view_blocks": summarize(uncached),
+            "render_cached": summarize(cached),
+            "bests_get": summarize(lookups),
+            "normalize_profile_data": summarize(normalize),
+        }
+
+    def columnar(self):
+        "building the index from the table against a columnar snapshot"
+        path = os.path.join(self.directory, "bests.columns")
+        self.bests.snapshot = ColumnarSnapshot(path)
+        tic = time.perf_counter()
+        self.bests.save_snapshot()
+        save = time.perf_counter() - tic
+
+        timings = {}
+        for name, snapshot in (("table", None), ("snapshot", ColumnarSnapshot(path))):
+            bests = Bests(self.db, self.monkeytype, snapshot=snapshot)
+            tic = time.perf_counter()
+            bests.build_index()
+            timings[name] = time.perf_counter() - tic
+        return {
+            "snapshot_bytes": os.path.getsize(path),
+            "snapshot_save_ms": save * 1000,
+            "build_index_from_table_ms": timings["table"] * 1000,
+            "build_index_from_snapshot_ms": timings["snapshot"] * 1000,
+        }
+
+    async def scenario_startup(self):
+        "time to the first leaderboard and the size of the first refresh, cold and warm"
+        if not self.bests.get_generation():
+            await self.refresh()
+        columns = ColumnarSnapshot(os.path.join(self.directory, "bests.columns"))
+        path = os.path.join(self.directory, "warm.json")
+        self.bests.snapshot = columns
+        scheduler = RefreshScheduler(self.monkeytype)
+        for username in self.users.get_all():
+            scheduler.mark_fetched(username)
+        WarmStart(path, self.bests, self.monkeytype, scheduler, self.logger).save()
+
+        results = {}
+        for start in ("cold", "warm"):
+            tic = time.perf_counter()
+            monkeytype = Monkeytype(api_url=self.monkeytype_api.url)
+            scheduler = RefreshScheduler(monkeytype)
+            bests = Bests(
+                self.db, monkeytype, snapshot=columns if start == "warm" else None
+            )
+            users = User(self.db, self.workspaces, self.logger)
+            leaderboard = Leaderboard(
+                self.db, bests, users, self.workspaces, self.logger
+            )
+            if start == "warm":
+                WarmStart(path, bests, monkeytype, scheduler, self.logger).load()
+            started = time.perf_counter()
+            leaderboard.build_view_blocks(leaderboard.default_query, CHANNEL)
+            first = time.perf_counter()
+            queue = scheduler.plan(users.get_all(), set(), max_age=scheduler.window)
+            results[start] = {
+                "startup_ms": (started - tic) * 1000,
+                "first_leaderboard_ms": (first - started) * 1000,
+                "first_refresh_users": len(queue),
+            }
+            await monkeytype.close()
+        return results
+
+    async def scenario_replicas(self):
+        """
+        how long a replica following the store takes to catch up with a
+        refresh another replica wrote, and whether their indexes agree
+        """
+        if self.args.backend != "sqlite":
+            return {"skipped": "only a sqlite store can be shared"}
+        if not self.bests.get_generation():
+            await self.refresh()
+        path = os.path.join(self.directory, "bench.sqlite")
+        leader, follower = (
+            Bests(open_storage("sqlite", path), self.monkeytype, change_log=1000)
+            for _ in range(2)
+        )
+        leader.build_index()
+        follower.build_index()
+
+        # the refreshing replica writes each user that changed on their own
+        bump_profiles(self.profiles, self.args.changed, seed=3)
+        for username, profile in self.profiles.items():
+            leader.sync(Bests.normalize(profile), users=[username])
+        tic = time.perf_counter()
+        follower.reload_if_changed()
+        catch_up = time.perf_counter() - tic
+        self.check_replicas(leader, follower)
+        tic = time.perf_counter()
+        follower.build_index()
+        rebuild = time.perf_counter() - tic
+
+        # a write from a replica whose index is stale still diffs against
+        # the rows the other one wrote, rather than inserting them twice
+        username = next(iter(self.profiles))
+        data = Bests.normalize(self.profiles[username])
+        follower.sync(data[1:], users=[username])
+        leader.sync(data, users=[username])
+        follower.reload_if_changed()
+        self.check_replicas(leader, follower)
+        rows = len(leader.table.search(user=username))
+        if rows != len({best.key for best in data}):
+            raise AssertionError(f"{username} has {rows} rows of {len(data)} bests")
+        return {
+            "catch_up_ms": catch_up * 1000,
+            "rebuild_ms": rebuild * 1000,
+        }
+
+    @staticmethod
+    def check_replicas(*replicas):
+        "fails when the indexes of replicas sharing a store disagree"
+        indexes = [replica.by_user for replica in replicas]
+        if any(index != indexes[0] for index in indexes):
+            raise AssertionError("replicas sharing a store disagree on personal bests")
+
+    async def interact(self, view_id, fragment):
+        "a settings submission: change the filters and refresh the view"
+        tic = time.perf_counter()
+        await self.leaderboard.update(view_id, fragment)
+        return time.perf_counter() - tic
+
+    async def interactions(self, name):
+        "runs concurrent settings submissions against freshly opened leaderboards"
+        fragments = [
+            {**self.leaderboard.default_query, "duration": duration}
+            for duration in ("15", "30", "60", "120")
+        ]
+        views = []
+        for idx in range(self.args.views):
+            view_id = f"V_{name}_{idx}"
+            self.leaderboard.table.insert(
+                {
+                    "view": view_id,
+                    "channel": CHANNEL,
+                    "fragment": self.leaderboard.default_query,
+                    "page": 0,
+                }
+            )
+            views.append(view_id)
+        tasks = [
+            self.interact(views[idx % len(views)], fragments[idx % len(fragments)])
+            for idx in range(self.args.interactions)
+        ]
+        return summarize(await asyncio.gather(*tasks))
+
+    async def scenario_interactions(self):
+        "interaction latency while idle and while a refresh cycle is running"
+        idle = await self.interactions("idle")
+        bump_profiles(self.profiles, self.args.changed, seed=2)
+        refresh = asyncio.create_task(self.refresh())
+        await asyncio.sleep(0)
+        busy = await self.interactions("busy")
+        await refresh
+        return {
+            "idle": idle,
+            "during_refresh": busy,
+            "views_update_calls": self.slack_api.count("views.update"),
+        }
+
+    async def close(self):
+        await self.monkeytype.close()
+        self.offload.close()
+
+
+async def main(args):
+    scenarios = args.scenarios.split(",")
+    profiles = make_profiles(args.users, args.bests, seed=args.seed)
+    monkeytype_api = await FakeMonkeytype(
+        profiles, latency=args.latency, rate_limit=args.rate_limit
+    ).start()
+    slack_api = await FakeSlack(latency=args.slack_latency).start()
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        bench = Bench(args, profiles, monkeytype_api, slack_api, directory)
+        try:
+            for scenario in (
+                "refresh",
+                "render",
+                "interactions",
+                "startup",
+                "replicas",
+            ):
+                if scenario in scenarios:
+                    results[scenario] = await getattr(bench, f"scenario_{scenario}")()
+        finally:
+            await bench.close()
+            await monkeytype_api.stop()
+            await slack_api.stop()
+    return {
+        "config": vars(args),
+        "python": platform.python_version(),
+        "timestamp": time.time(),
+        "scenarios": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--bests", type=int, default=20, help="personal bests per user")
+    parser.add_argument("--backend", default="sqlite", choices=("sqlite", "tinydb"))
+    parser.add_argument(
+        "--db-batch-size", type=int, default=1, help="TinyDB writes buffered per flush"
+    )
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument(
+        "--offload",
+        default="inline",
+        choices=Offload.modes,
+        help="where profiles are decoded and normalized",
+    )
+    parser.add_argument("--offload-workers", type=int, default=None)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="monkeytype API latency in seconds"
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=int,
+        default=None,
+        help="monkeytype requests allowed per minute",
+    )
+    parser.add_argument(
+        "--slack-latency", type=float, default=0.0, help="slack API latency in seconds"
+    )
+    parser.add_argument(
+        "--changed",
+        type=float,
+        default=0.05,
+        help="share of users setting a new PB per cycle",
+    )
+    parser.add_argument(
+        "--refresh-window",
+        type=float,
+        default=1.0,
+        help="seconds a refresh cycle's fetches are spread over",
+    )
+    parser.add_argument("--views", type=int, default=20, help="open leaderboard views")
+    parser.add_argument("--interactions", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--scenarios", default="refresh,render,interactions,startup,replicas"
+    )
+    parser.add_argument(
+        "--output", default=None, help="write the results to this JSON file"
+    )
+    args = parser.parse_args()
+
+    report = asyncio.run(main(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text)
+    print(text)